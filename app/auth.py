@@ -1,59 +1,84 @@
 """
 API Key认证中间件
 """
-from typing import Optional
-from fastapi import HTTPException, Security, Depends, Header, Query
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+import time
+from typing import Any, Dict, FrozenSet, Optional
+from fastapi import FastAPI, HTTPException, Depends, Request
 from app.config import Config
 
 
-# HTTP Bearer安全方案
-security = HTTPBearer(auto_error=False)
+# Authorization头中的Bearer前缀（小写，用于不区分大小写比较）
+_BEARER_PREFIX = "bearer "
+_BEARER_PREFIX_LEN = len(_BEARER_PREFIX)
 
+# OpenAPI文档中声明的认证方式（仅用于文档和Swagger UI的Authorize，实际认证由verify_api_key完成）
+OPENAPI_SECURITY_SCHEMES: Dict[str, Dict[str, Any]] = {
+    "APIKeyHeader": {"type": "apiKey", "in": "header", "name": "X-API-Key"},
+    "HTTPBearer": {"type": "http", "scheme": "bearer"},
+    "APIKeyQuery": {"type": "apiKey", "in": "query", "name": "api_key"},
+}
 
-async def get_api_key_from_header(
-    authorization: Optional[HTTPAuthorizationCredentials] = Security(security),
-    x_api_key: Optional[str] = Header(None, alias="X-API-Key"),
-) -> Optional[str]:
-    """
-    从Header中获取API Key
+# 需要认证的路由通过openapi_extra引用，任一方式均可
+AUTH_OPENAPI_EXTRA: Dict[str, Any] = {
+    "security": [{name: []} for name in OPENAPI_SECURITY_SCHEMES],
+}
+
+# 已验证API Key的短期缓存：api_key -> 验证通过的时间（time.monotonic）
+_AUTH_CACHE_TTL = 30.0
+_AUTH_CACHE_MAX_SIZE = 1024
+_auth_cache: Dict[str, float] = {}
+# 缓存对应的API Key集合，配置重新加载后集合对象变化，缓存随之失效
+_auth_cache_keys: FrozenSet[str] = frozenset()
+
+
+def _check_api_key(api_key: str) -> bool:
+    """检查API Key是否有效（命中短期缓存时跳过集合查找）"""
+    global _auth_cache_keys
+    # 长度不匹配任何已配置的Key时直接拒绝，无需对（可能很长的）输入做哈希
+    if len(api_key) not in Config.API_KEY_LENGTHS:
+        return False
     
-    支持格式：
-    - X-API-Key: <api_key>
-    - Authorization: Bearer <api_key>
-    """
-    # 方式1: 从X-API-Key获取
-    if x_api_key:
-        return x_api_key
+    if _auth_cache_keys is not Config.API_KEYS_SET:
+        _auth_cache.clear()
+        _auth_cache_keys = Config.API_KEYS_SET
     
-    # 方式2: 从Authorization Bearer获取
-    if authorization:
-        return authorization.credentials
+    now = time.monotonic()
+    ts = _auth_cache.get(api_key)
+    if ts is not None and now - ts < _AUTH_CACHE_TTL:
+        return True
     
-    return None
+    if api_key not in Config.API_KEYS_SET:
+        return False
+    
+    if len(_auth_cache) >= _AUTH_CACHE_MAX_SIZE and api_key not in _auth_cache:
+        # 淘汰最早验证的条目
+        _auth_cache.pop(min(_auth_cache, key=_auth_cache.get))
+    _auth_cache[api_key] = now
+    return True
 
 
-async def get_api_key_from_query(
-    api_key: Optional[str] = Query(None, alias="api_key"),
-) -> Optional[str]:
-    """
-    从Query参数中获取API Key
-    
-    格式: ?api_key=xxx
-    """
-    return api_key
+def _parse_bearer(authorization: Optional[str]) -> Optional[str]:
+    """从Authorization头中解析Bearer凭证，格式不匹配时返回None"""
+    if (
+        authorization
+        and len(authorization) > _BEARER_PREFIX_LEN
+        and authorization[:_BEARER_PREFIX_LEN].lower() == _BEARER_PREFIX
+    ):
+        return authorization[_BEARER_PREFIX_LEN:].strip() or None
+    return None
 
 
-async def verify_api_key(
-    api_key_header: Optional[str] = Depends(get_api_key_from_header),
-    api_key_query: Optional[str] = Depends(get_api_key_from_query),
-) -> str:
+async def verify_api_key(request: Request) -> str:
     """
     验证API Key
     
+    支持格式（按优先级）：
+    - Header: X-API-Key: <api_key>
+    - Header: Authorization: Bearer <api_key>
+    - Query参数: ?api_key=xxx
+    
     Args:
-        api_key_header: 从Header获取的API Key
-        api_key_query: 从Query参数获取的API Key
+        request: 当前请求对象
     
     Returns:
         API Key字符串
@@ -61,7 +86,12 @@ async def verify_api_key(
     Raises:
         HTTPException: 如果API Key无效
     """
-    api_key = api_key_header or api_key_query
+    headers = request.headers
+    api_key = (
+        headers.get("x-api-key")
+        or _parse_bearer(headers.get("authorization"))
+        or request.query_params.get("api_key")
+    )
     
     if not api_key:
         raise HTTPException(
@@ -69,7 +99,7 @@ async def verify_api_key(
             detail="缺少API Key。请在Header中提供X-API-Key或Authorization: Bearer <api_key>"
         )
     
-    if api_key not in Config.API_KEYS:
+    if not _check_api_key(api_key):
         raise HTTPException(
             status_code=401,
             detail="无效的API Key"
@@ -82,3 +112,17 @@ async def verify_api_key(
 def require_auth(api_key: str = Depends(verify_api_key)) -> str:
     """认证依赖项"""
     return api_key
+
+
+def add_openapi_security(app: FastAPI) -> None:
+    """在应用的OpenAPI文档中加入认证方式（components.securitySchemes）"""
+    default_openapi = app.openapi
+    
+    def openapi() -> Dict[str, Any]:
+        schema = default_openapi()  # 首次调用时生成并缓存到app.openapi_schema
+        schemes = schema.setdefault("components", {}).setdefault("securitySchemes", {})
+        for name, scheme in OPENAPI_SECURITY_SCHEMES.items():
+            schemes.setdefault(name, scheme)
+        return schema
+    
+    app.openapi = openapi
@@ -1,11 +1,34 @@
 """
 配置文件：从YAML文件读取配置信息
 """
+import os
 import yaml
-from typing import List, Dict, Optional, Any
+from typing import List, Dict, Optional, Any, Tuple, FrozenSet
 from pathlib import Path
 from app.utils.logger import logger
 
+# 优先使用libyaml的C解析器，不可用时回退到纯Python实现
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# YAML解析结果缓存：键为 (绝对路径, mtime_ns, 文件大小)，文件未变化时跳过重新解析
+_YAML_CACHE_MAX_SIZE = 8
+_yaml_cache: Dict[Tuple[str, int, int], Dict[str, Any]] = {}
+
+
+def _load_yaml_file(file_path: Path) -> Dict[str, Any]:
+    """读取并解析YAML文件（文件未变化时直接返回缓存结果）"""
+    st = file_path.stat()
+    key = (str(file_path.resolve()), st.st_mtime_ns, st.st_size)
+    data = _yaml_cache.get(key)
+    if data is None:
+        # 一次性读取全部字节交给解析器（按UTF-8解码），避免文本模式下的多次小块读取
+        data = yaml.load(file_path.read_bytes(), Loader=YamlLoader) or {}
+        if len(_yaml_cache) >= _YAML_CACHE_MAX_SIZE:
+            # FIFO淘汰最早写入的条目
+            _yaml_cache.pop(next(iter(_yaml_cache)))
+        _yaml_cache[key] = data
+    return data
+
 
 class Config:
     """应用配置类"""
@@ -24,6 +47,9 @@ class Config:
     LORA_MODELS_DIR: Optional[str] = None
     LORA_MODELS_LIST: Optional[str] = None
     LORA_TRIGGER_WORDS: Optional[List[str]] = None  # 全局LoRA触发词（如果单个LoRA未配置）
+    _lora_trigger_words_cache: Optional[List[str]] = None  # get_lora_trigger_words的计算结果
+    _lora_trigger_words_casefold_cache: Tuple[str, ...] = ()  # casefold形式的触发词
+    _lora_trigger_str_cache: str = ""  # 逗号分隔的触发词字符串
     
     # 默认采样方法
     DEFAULT_SCHEDULER: Optional[str] = None
@@ -33,10 +59,20 @@ class Config:
     MINIO_ACCESS_KEY: str = "minioadmin"
     MINIO_SECRET_KEY: str = "minioadmin"
     MINIO_BUCKET: str = "sd-images"
+    MINIO_UPLOAD_WORKERS: int = 16  # 批量上传的并发线程数
+    IMAGE_PNG_COMPRESS_LEVEL: int = 1  # PNG压缩级别（0-9），无损，级别越低编码越快、文件略大
+    IMAGE_JPEG_QUALITY: int = 90  # JPEG质量（1-100）
+    IMAGE_WEBP_QUALITY: int = 85  # WebP质量（1-100）
     
     # API认证配置
     API_KEYS: List[str] = []
+    API_KEYS_SET: FrozenSet[str] = frozenset()  # 用于O(1)成员检查
+    API_KEY_LENGTHS: FrozenSet[int] = frozenset()  # 已配置API Key的长度集合，用于快速拒绝
     API_KEY_HEADER: str = "X-API-Key"
+    MAX_INIT_IMAGE_SIZE: int = 8 * 1024 * 1024  # init_image（base64字符串）的最大长度
+    
+    # CORS配置：允许跨域访问的来源（正则表达式）
+    CORS_ALLOW_ORIGIN_REGEX: str = r"^https?://(localhost|127\.0\.0\.1)(:\d+)?$"
     
     # 运行设备
     DEVICE: str = "cuda"
@@ -44,6 +80,10 @@ class Config:
     # 回调配置
     CALLBACK_RETRY_TIMES: int = 3
     CALLBACK_RETRY_INTERVAL: int = 5
+    CALLBACK_MAX_CONCURRENCY: int = 32  # 同时进行的回调请求上限
+    CALLBACK_BATCH: bool = False  # 同一回调URL的通知合并为 {"events": [...]} 批量推送
+    CALLBACK_BATCH_MAX_SIZE: int = 256  # 单次批量推送的最大通知数
+    CALLBACK_BATCH_QUEUE_SIZE: int = 10000  # 每个回调URL的待推送队列上限
     
     # 健康检查接口配置
     HEALTH_CHECK_NO_AUTH: bool = True
@@ -59,15 +99,28 @@ class Config:
     LLM_TEMPERATURE: float = 0.7
     LLM_TIMEOUT: int = 30
     LLM_PROMPT_PREFIX: Optional[str] = None  # 提示词前缀，会在生成的prompt前自动添加
+    LLM_STREAM: bool = False  # 文生图/图生图文本转换使用流式响应，JSON输出完整后不再解析后续内容
+    LLM_RESPONSE_FORMAT: str = "json_object"  # json_object 或 json_schema（严格按prompt/negative_prompt结构输出）
+    LLM_CACHE_SIZE: int = 2048  # 自然语言转换结果的LRU缓存条目数，0表示不缓存
+    LLM_CACHE_TTL: float = 0  # 转换结果缓存的有效期（秒），0表示不过期
+    LLM_RESPONSE_CACHE_SIZE: int = 1024  # LLM响应缓存条目数（仅低温度时生效），0表示不缓存
+    
+    # 语义缓存配置（可选）：相似的自然语言输入复用已有的转换结果
+    LLM_SEMANTIC_CACHE_ENABLED: bool = False
+    LLM_SEMANTIC_CACHE_EMBEDDING_MODEL: str = "text-embedding-3-small"  # 使用llm.api_base的/embeddings接口
+    LLM_SEMANTIC_CACHE_THRESHOLD: float = 0.92  # 命中所需的最小余弦相似度
+    LLM_SEMANTIC_CACHE_MAX_ENTRIES: int = 5000
     
     # 图生图专用VL模型配置（可选）
     LLM_VISION_MODEL: Optional[str] = None  # 图生图使用的VL模型（如gpt-4o, claude-3-sonnet）
     LLM_VISION_API_BASE: Optional[str] = None  # VL模型的API地址（如果与普通模型不同）
     LLM_VISION_API_KEY: Optional[str] = None  # VL模型的API密钥（如果与普通模型不同）
+    LLM_VISION_MAX_IMAGE_DIM: int = 1024  # 发送给VL模型前原图最长边的上限（像素），0表示不缩小
     
     # LLM提示词配置
     PROMPTS_FILE: str = "prompts.yaml"  # 提示词配置文件路径
     LLM_PROMPTS: Dict[str, Any] = {}  # 存储加载的提示词
+    _flat_prompts: Dict[Tuple[str, str], str] = {}  # 展平后的提示词，键为 (类别, 类型)
     
     @classmethod
     def load_config(cls, config_path: Optional[str] = None) -> None:
@@ -82,8 +135,7 @@ class Config:
                 f"请创建配置文件或使用 config.yaml.example 作为模板"
             )
         
-        with open(config_file, 'r', encoding='utf-8') as f:
-            cls._config_data = yaml.safe_load(f) or {}
+        cls._config_data = _load_yaml_file(config_file)
         
         # 加载SD模型配置
         sd_config = cls._config_data.get("sd_model", {})
@@ -112,14 +164,27 @@ class Config:
         cls.MINIO_ACCESS_KEY = minio_config.get("access_key", cls.MINIO_ACCESS_KEY)
         cls.MINIO_SECRET_KEY = minio_config.get("secret_key", cls.MINIO_SECRET_KEY)
         cls.MINIO_BUCKET = minio_config.get("bucket", cls.MINIO_BUCKET)
+        cls.MINIO_UPLOAD_WORKERS = minio_config.get("upload_workers", cls.MINIO_UPLOAD_WORKERS)
+        cls.IMAGE_PNG_COMPRESS_LEVEL = minio_config.get("png_compress_level", cls.IMAGE_PNG_COMPRESS_LEVEL)
+        cls.IMAGE_JPEG_QUALITY = minio_config.get("jpeg_quality", cls.IMAGE_JPEG_QUALITY)
+        cls.IMAGE_WEBP_QUALITY = minio_config.get("webp_quality", cls.IMAGE_WEBP_QUALITY)
         
         # 加载API认证配置
         api_config = cls._config_data.get("api", {})
         api_keys = api_config.get("keys", [])
         if isinstance(api_keys, str):
             api_keys = [key.strip() for key in api_keys.split(",") if key.strip()]
-        cls.API_KEYS = api_keys if isinstance(api_keys, list) else []
+        # YAML中未加引号的纯数字Key会被解析为数字，统一转换为字符串（请求头中的Key总是字符串）
+        cls.API_KEYS = [str(key) for key in api_keys if key is not None] if isinstance(api_keys, list) else []
+        cls.API_KEYS_SET = frozenset(cls.API_KEYS)
+        cls.API_KEY_LENGTHS = frozenset(len(key) for key in cls.API_KEYS_SET)
         cls.API_KEY_HEADER = api_config.get("key_header", cls.API_KEY_HEADER)
+        cls.MAX_INIT_IMAGE_SIZE = api_config.get("max_init_image_size", cls.MAX_INIT_IMAGE_SIZE)
+        
+        # 加载CORS配置
+        cls.CORS_ALLOW_ORIGIN_REGEX = cls._config_data.get("cors", {}).get(
+            "allow_origin_regex", cls.CORS_ALLOW_ORIGIN_REGEX
+        )
         
         # 加载运行设备
         cls.DEVICE = cls._config_data.get("device", cls.DEVICE)
@@ -128,6 +193,10 @@ class Config:
         callback_config = cls._config_data.get("callback", {})
         cls.CALLBACK_RETRY_TIMES = callback_config.get("retry_times", cls.CALLBACK_RETRY_TIMES)
         cls.CALLBACK_RETRY_INTERVAL = callback_config.get("retry_interval", cls.CALLBACK_RETRY_INTERVAL)
+        cls.CALLBACK_MAX_CONCURRENCY = callback_config.get("max_concurrency", cls.CALLBACK_MAX_CONCURRENCY)
+        cls.CALLBACK_BATCH = callback_config.get("batch", cls.CALLBACK_BATCH)
+        cls.CALLBACK_BATCH_MAX_SIZE = callback_config.get("batch_max_size", cls.CALLBACK_BATCH_MAX_SIZE)
+        cls.CALLBACK_BATCH_QUEUE_SIZE = callback_config.get("batch_queue_size", cls.CALLBACK_BATCH_QUEUE_SIZE)
         
         # 加载健康检查配置
         cls.HEALTH_CHECK_NO_AUTH = cls._config_data.get("health_check", {}).get("no_auth", cls.HEALTH_CHECK_NO_AUTH)
@@ -144,12 +213,29 @@ class Config:
         cls.LLM_TEMPERATURE = llm_config.get("temperature", cls.LLM_TEMPERATURE)
         cls.LLM_TIMEOUT = llm_config.get("timeout", cls.LLM_TIMEOUT)
         cls.LLM_PROMPT_PREFIX = llm_config.get("prompt_prefix")
+        cls.LLM_STREAM = llm_config.get("stream", cls.LLM_STREAM)
+        cls.LLM_RESPONSE_FORMAT = llm_config.get("response_format", cls.LLM_RESPONSE_FORMAT)
+        cls.LLM_CACHE_SIZE = llm_config.get("cache_size", cls.LLM_CACHE_SIZE)
+        cls.LLM_CACHE_TTL = llm_config.get("cache_ttl", cls.LLM_CACHE_TTL)
+        cls.LLM_RESPONSE_CACHE_SIZE = llm_config.get("response_cache_size", cls.LLM_RESPONSE_CACHE_SIZE)
         
         # 加载图生图VL模型配置（可选）
         vision_config = llm_config.get("vision", {})
         cls.LLM_VISION_MODEL = vision_config.get("model")  # 如果未配置，使用普通模型
         cls.LLM_VISION_API_BASE = vision_config.get("api_base")  # 如果未配置，使用普通API地址
         cls.LLM_VISION_API_KEY = vision_config.get("api_key")  # 如果未配置，使用普通API密钥
+        cls.LLM_VISION_MAX_IMAGE_DIM = vision_config.get("max_image_dim", cls.LLM_VISION_MAX_IMAGE_DIM)
+        
+        # 加载语义缓存配置（可选）
+        semantic_cache_config = llm_config.get("semantic_cache", {})
+        cls.LLM_SEMANTIC_CACHE_ENABLED = semantic_cache_config.get("enabled", cls.LLM_SEMANTIC_CACHE_ENABLED)
+        cls.LLM_SEMANTIC_CACHE_EMBEDDING_MODEL = semantic_cache_config.get(
+            "embedding_model", cls.LLM_SEMANTIC_CACHE_EMBEDDING_MODEL
+        )
+        cls.LLM_SEMANTIC_CACHE_THRESHOLD = semantic_cache_config.get("threshold", cls.LLM_SEMANTIC_CACHE_THRESHOLD)
+        cls.LLM_SEMANTIC_CACHE_MAX_ENTRIES = semantic_cache_config.get(
+            "max_entries", cls.LLM_SEMANTIC_CACHE_MAX_ENTRIES
+        )
         
         # 加载LoRA模型
         cls.load_lora_models()
@@ -160,6 +246,9 @@ class Config:
     @classmethod
     def load_lora_models(cls) -> Optional[List[Dict[str, Any]]]:
         """加载LoRA模型配置"""
+        # LoRA配置可能变化，使触发词缓存失效
+        cls._lora_trigger_words_cache = None
+        
         # 方式1: 从配置中直接读取LORA_MODELS列表（已设置）
         if cls.LORA_MODELS is not None:
             return cls.LORA_MODELS if cls.LORA_MODELS else None
@@ -167,14 +256,20 @@ class Config:
         # 方式2: 从LORA_MODELS_DIR + LORA_MODELS_LIST配置
         if cls.LORA_MODELS_DIR and cls.LORA_MODELS_LIST:
             lora_list = [f.strip() for f in cls.LORA_MODELS_LIST.split(",") if f.strip()]
-            cls.LORA_MODELS = []
-            for lora_file in lora_list:
-                lora_path = Path(cls.LORA_MODELS_DIR) / lora_file
-                if lora_path.exists():
-                    cls.LORA_MODELS.append({
-                        "path": str(lora_path),
-                        "weight": 1.0
-                    })
+            # 一次性列出目录顶层的条目，避免逐个文件stat；
+            # 位于子目录中的条目（如 "sub/model.safetensors"）不在顶层列表中，单独检查是否存在
+            try:
+                with os.scandir(cls.LORA_MODELS_DIR) as entries:
+                    present = {entry.name for entry in entries}
+            except (FileNotFoundError, NotADirectoryError):
+                present = set()
+            lora_dir = Path(cls.LORA_MODELS_DIR)
+            cls.LORA_MODELS = [
+                {"path": str(lora_dir / lora_file), "weight": 1.0}
+                for lora_file in lora_list
+                if lora_file in present
+                or (("/" in lora_file or os.sep in lora_file) and (lora_dir / lora_file).exists())
+            ]
             if cls.LORA_MODELS:
                 return cls.LORA_MODELS
         
@@ -185,11 +280,44 @@ class Config:
     @classmethod
     def get_lora_trigger_words(cls) -> List[str]:
         """
-        获取所有LoRA的触发词列表
+        获取所有LoRA的触发词列表（首次调用时计算，之后返回缓存结果）
         
         Returns:
             触发词列表（去重后）
         """
+        if cls._lora_trigger_words_cache is None:
+            cls._lora_trigger_words_cache = cls._collect_lora_trigger_words()
+            cls._lora_trigger_words_casefold_cache = tuple(w.casefold() for w in cls._lora_trigger_words_cache)
+            cls._lora_trigger_str_cache = ", ".join(cls._lora_trigger_words_cache)
+        return cls._lora_trigger_words_cache
+    
+    @classmethod
+    def get_lora_trigger_words_casefold(cls) -> Tuple[str, ...]:
+        """
+        获取casefold形式的LoRA触发词（用于不区分大小写的包含检查，与get_lora_trigger_words一同缓存）
+        
+        Returns:
+            casefold后的触发词元组
+        """
+        if cls._lora_trigger_words_cache is None:
+            cls.get_lora_trigger_words()
+        return cls._lora_trigger_words_casefold_cache
+    
+    @classmethod
+    def get_lora_trigger_str(cls) -> str:
+        """
+        获取用于添加到提示词前的LoRA触发词字符串（逗号分隔，与get_lora_trigger_words一同缓存）
+        
+        Returns:
+            触发词字符串，未配置触发词时为空字符串
+        """
+        if cls._lora_trigger_words_cache is None:
+            cls.get_lora_trigger_words()
+        return cls._lora_trigger_str_cache
+    
+    @classmethod
+    def _collect_lora_trigger_words(cls) -> List[str]:
+        """从LoRA配置中收集触发词（去重）"""
         trigger_words_set = set()
         
         # 从每个LoRA配置中收集触发词
@@ -223,15 +351,24 @@ class Config:
                 f"将使用代码中的默认提示词"
             )
             cls.LLM_PROMPTS = {}
+            cls._flat_prompts = {}
             return
         
         try:
-            with open(prompts_file, 'r', encoding='utf-8') as f:
-                cls.LLM_PROMPTS = yaml.safe_load(f) or {}
+            cls.LLM_PROMPTS = _load_yaml_file(prompts_file)
             logger.info(f"提示词配置加载成功: {cls.PROMPTS_FILE}")
         except Exception as e:
             logger.error(f"加载提示词配置失败: {e}")
             cls.LLM_PROMPTS = {}
+        
+        # 展平为 (类别, 类型) -> 提示词，get_prompt只需一次字典查找
+        cls._flat_prompts = {
+            (category, prompt_type): prompt
+            for category, category_config in cls.LLM_PROMPTS.items()
+            if isinstance(category_config, dict)
+            for prompt_type, prompt in category_config.items()
+            if prompt is not None
+        }
     
     @classmethod
     def get_prompt(cls, category: str, prompt_type: str, default: Optional[str] = None) -> Optional[str]:
@@ -246,16 +383,7 @@ class Config:
         Returns:
             提示词字符串，如果未找到则返回default
         """
-        if not cls.LLM_PROMPTS:
-            return default
-        
-        category_config = cls.LLM_PROMPTS.get(category, {})
-        prompt = category_config.get(prompt_type)
-        
-        if prompt is None:
-            return default
-        
-        return prompt
+        return cls._flat_prompts.get((category, prompt_type), default)
     
     @classmethod
     def validate(cls) -> List[str]:
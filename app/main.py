@@ -12,16 +12,39 @@ if str(project_root) not in sys.path:
 # 尽早初始化日志系统，抑制第三方库的详细日志
 from app.utils.logger import logger
 
+import asyncio
 from contextlib import asynccontextmanager
 import gc
-from fastapi import FastAPI, HTTPException
+from email.utils import format_datetime
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import FileResponse, ORJSONResponse, Response, StreamingResponse
 from app.routers import image
+from app.auth import add_openapi_security
+from app.services import llm_service
 from app.config import Config
 from app.models.schemas import HealthResponse
 
+try:
+    import torch
+except ImportError:  # 仅CPU且未安装torch的部署
+    torch = None
+
+# 图片代理流式传输的分块大小
+IMAGE_STREAM_CHUNK_SIZE = 512 * 1024
+
+# 不超过该大小的图片一次性读取后返回，不走流式传输
+IMAGE_BUFFER_MAX_SIZE = 1024 * 1024
+
+# 图片扩展名 -> 内容类型
+IMAGE_MIME_TYPES = {
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+}
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -41,14 +64,12 @@ async def lifespan(app: FastAPI):
     else:
         logger.info("配置验证通过")
 
-    # 预加载模型（通过访问服务实例触发）
+    # 预加载模型并创建服务实例（单例保存在image模块中，通过image.get_*_service()获取）
     logger.info("预加载SD模型...")
-    try:
-        from app.routers.image import get_sd_service
-        sd_service = get_sd_service()
-        logger.info("SD模型预加载完成")
-    except Exception as e:
-        logger.error(f"SD模型预加载失败: {e}", exc_info=True)
+    image.init_services()
+
+    sd_service = image.get_sd_service()
+    app.state.model_loaded = sd_service is not None and sd_service.text2img_pipeline is not None
 
     logger.info("=" * 50)
     logger.info("服务启动完成！")
@@ -61,23 +82,21 @@ async def lifespan(app: FastAPI):
     logger.info("服务正在关闭...")
     try:
         # 清理路由中的服务实例
-        from app.routers.image import cleanup_services
-        cleanup_services()
+        app.state.model_loaded = False
+        await image.cleanup_services()
 
         # 清理LLM服务（如果有）
-        from app.services.llm_service import _llm_service
-        if _llm_service is not None:
-            # LLM服务通常不需要特殊清理，主要是HTTP客户端会自动关闭
-            gc.collect()
+        if llm_service._llm_service is not None:
+            await llm_service._llm_service.aclose()
             logger.info("LLM服务已清理")
 
-        # 最后强制垃圾回收
+        # 服务实例的引用已释放，只在清理CUDA缓存前做一次完整垃圾回收，
+        # 回收模型中可能存在的循环引用，使其占用的显存可以被释放
         gc.collect()
 
         # 清理PyTorch CUDA缓存（如果有CUDA）
         try:
-            import torch
-            if torch.cuda.is_available():
+            if torch is not None and torch.cuda.is_available():
                 torch.cuda.empty_cache()
                 torch.cuda.ipc_collect()
                 logger.info("PyTorch CUDA缓存已清理")
@@ -94,21 +113,25 @@ app = FastAPI(
     title="SD模型API服务",
     description="基于Stable Diffusion的图片生成API服务，支持文生图和图生图",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
     lifespan=lifespan,
 )
 
-# 配置CORS（如果需要）
+# 配置CORS：来源通过config.yaml中的cors.allow_origin_regex配置（Starlette启动时编译一次）
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # 生产环境应该限制特定域名
+    allow_origin_regex=Config.CORS_ALLOW_ORIGIN_REGEX,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "OPTIONS"],
+    allow_headers=["Authorization", "X-API-Key", "Content-Type"],
 )
 
 # 注册路由
 app.include_router(image.router)
 
+# 在API文档中声明认证方式（Swagger UI的Authorize按钮）
+add_openapi_security(app)
+
 # 配置静态文件服务
 static_dir = project_root / "static"
 if static_dir.exists():
@@ -116,31 +139,37 @@ if static_dir.exists():
     app.mount("/static", StaticFiles(directory=str(static_dir)), name="static")
 
 
-@app.get("/health", response_model=HealthResponse, summary="健康检查")
-@app.get("/api/health", response_model=HealthResponse, summary="健康检查")
-async def health_check():
+@app.get(
+    "/health",
+    response_model=None,
+    responses={200: {"model": HealthResponse}},  # 仅用于API文档，不对返回值做二次校验
+    summary="健康检查",
+)
+async def health_check(request: Request):
     """
     健康检查接口
     
     返回服务状态和模型加载状态
     默认免认证（可通过config.yaml中的health_check.no_auth配置）
     """
-    # 检查模型是否已加载
-    model_loaded = False
-    try:
-        # 尝试获取SD服务实例来判断模型是否已加载
-        from app.routers.image import get_sd_service
-        sd_service = get_sd_service()
-        model_loaded = sd_service is not None and sd_service.text2img_pipeline is not None
-    except Exception:
-        pass
-
-    return HealthResponse(
+    # 模型加载状态在启动时计算；字段均由服务端生成，跳过构造时的校验
+    return HealthResponse.model_construct(
         status="ok",
-        model_loaded=model_loaded
+        model_loaded=getattr(request.app.state, "model_loaded", False)
     )
 
 
+# /api/health 作为 /health 的别名，复用同一处理函数，不重复出现在API文档中
+app.add_api_route(
+    "/api/health",
+    health_check,
+    methods=["GET"],
+    response_model=None,
+    summary="健康检查",
+    include_in_schema=False,
+)
+
+
 @app.get("/", summary="根路径")
 async def root():
     """根路径，返回前端页面"""
@@ -157,35 +186,71 @@ async def root():
         }
 
 
+def _read_object(response) -> bytes:
+    """一次性读取MinIO对象的全部内容，读取结束后释放连接"""
+    try:
+        return response.read()
+    finally:
+        response.close()
+        response.release_conn()
+
+
+def _iter_object(response):
+    """逐块读取MinIO对象，读取结束后释放连接"""
+    try:
+        yield from response.stream(IMAGE_STREAM_CHUNK_SIZE)
+    finally:
+        response.close()
+        response.release_conn()
+
+
 @app.get("/api/v1/images/{bucket}/{filename:path}", summary="图片代理接口")
-async def proxy_image(bucket: str, filename: str):
+async def proxy_image(bucket: str, filename: str, request: Request):
     """
     图片代理接口：从MinIO获取图片并返回给客户端
     
     这样可以将MinIO的内部URL转换为可通过服务端访问的URL
     """
-    try:
-        # 使用单例OSS服务实例
-        from app.routers.image import get_oss_service
-        oss_service = get_oss_service()
-
-        # 从MinIO获取图片对象
-        response = oss_service.client.get_object(bucket, filename)
+    # 使用启动时创建的OSS服务实例
+    oss_service = image.get_oss_service()
+    if oss_service is None:
+        raise HTTPException(status_code=503, detail="OSS服务未初始化")
 
-        # 确定内容类型
-        content_type = "image/png"  # 默认
-        if filename.lower().endswith('.jpg') or filename.lower().endswith('.jpeg'):
-            content_type = "image/jpeg"
-        elif filename.lower().endswith('.png'):
-            content_type = "image/png"
-
-        # 返回图片流
+    try:
+        # 先获取对象元数据，客户端缓存仍有效时直接返回304，无需读取图片内容
+        # （MinIO客户端是同步的，放到线程中执行，不阻塞事件循环）
+        stat = await asyncio.to_thread(oss_service.client.stat_object, bucket, filename)
+        cache_headers = {
+            "Cache-Control": "public, max-age=31536000, immutable",  # 缓存1年（文件名唯一，内容不会变化）
+        }
+        if stat.etag:
+            etag = f'"{stat.etag}"'
+            cache_headers["ETag"] = etag
+            if_none_match = request.headers.get("if-none-match")
+            if if_none_match and (
+                if_none_match.strip() == "*"
+                or etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+            ):
+                return Response(status_code=304, headers=cache_headers)
+        if stat.last_modified:
+            cache_headers["Last-Modified"] = format_datetime(stat.last_modified, usegmt=True)
+
+        # 确定内容类型（默认PNG）
+        content_type = IMAGE_MIME_TYPES.get(filename.rpartition(".")[2].lower(), "image/png")
+
+        # 从MinIO获取图片对象（同样在线程中执行）
+        response = await asyncio.to_thread(oss_service.client.get_object, bucket, filename)
+
+        # 小图片在线程中一次性读取后直接返回，避免逐块异步迭代的开销
+        if stat.size is not None and stat.size <= IMAGE_BUFFER_MAX_SIZE:
+            data = await asyncio.to_thread(_read_object, response)
+            return Response(content=data, media_type=content_type, headers=cache_headers)
+
+        # 大图片流式返回（同步迭代器由Starlette在线程池中逐块读取）
         return StreamingResponse(
-            response.stream(32 * 1024),  # 32KB chunks
+            _iter_object(response),
             media_type=content_type,
-            headers={
-                "Cache-Control": "public, max-age=31536000",  # 缓存1年
-            }
+            headers=cache_headers,
         )
     except Exception as e:
         logger.error(f"获取图片失败: bucket={bucket}, filename={filename}, error={str(e)}")
@@ -1,9 +1,13 @@
 """
 Pydantic数据模型：请求/响应Schema
 """
+import re
 from typing import Optional, List, Literal
-from pydantic import BaseModel, Field, field_validator
-from urllib.parse import urlparse
+from pydantic import BaseModel, Field, model_validator
+
+# 回调URL校验：http(s)协议 + 非空主机部分（以@、:以外的字符开头），整串不含空白（使用fullmatch）
+_CALLBACK_URL_RE = re.compile(r"https?://[^\s/?#@:][^\s/?#]*\S*", re.IGNORECASE)
+_CALLBACK_URL_SCHEME_RE = re.compile(r"^https?://", re.IGNORECASE)
 
 
 class GenerateRequest(BaseModel):
@@ -20,35 +24,29 @@ class GenerateRequest(BaseModel):
     scheduler: Optional[str] = Field(None, description="采样方法/scheduler名称")
     num_images: Optional[int] = Field(1, ge=1, le=10, description="生成图片张数，默认为1")
     seed: Optional[int] = Field(None, description="随机种子，用于控制生成结果的可复现性")
-    output_format: Optional[Literal["png", "jpg", "jpeg"]] = Field("png", description="输出图片格式")
+    output_format: Optional[Literal["png", "jpg", "jpeg", "webp"]] = Field("png", description="输出图片格式")
     callback_url: Optional[str] = Field(None, description="回调URL，生成完成后将结果推送到该URL")
     
-    @field_validator("callback_url")
-    @classmethod
-    def validate_callback_url(cls, v):
-        """验证callback_url是否为有效的URL格式"""
-        if v is None or v == "":
-            return None
-        # 检查是否包含协议
-        parsed = urlparse(v)
-        if not parsed.scheme or parsed.scheme not in ["http", "https"]:
-            raise ValueError("callback_url必须是有效的URL，且必须包含http://或https://协议")
-        if not parsed.netloc:
-            raise ValueError("callback_url必须包含有效的域名或IP地址")
-        return v
-    
-    @field_validator("num_images")
-    @classmethod
-    def validate_num_images(cls, v):
-        if v and (v < 1 or v > 10):
+    @model_validator(mode="after")
+    def validate_request(self):
+        """一次性校验请求字段（callback_url、num_images、prompt/natural_language）"""
+        # 验证callback_url是否为有效的URL格式
+        if not self.callback_url:
+            self.callback_url = None
+        else:
+            if not _CALLBACK_URL_RE.fullmatch(self.callback_url):
+                if not _CALLBACK_URL_SCHEME_RE.match(self.callback_url):
+                    raise ValueError("callback_url必须是有效的URL，且必须包含http://或https://协议")
+                raise ValueError("callback_url必须包含有效的域名或IP地址")
+        
+        if self.num_images and (self.num_images < 1 or self.num_images > 10):
             raise ValueError("num_images必须在1-10之间")
-        return v or 1
-    
-    def model_post_init(self, __context):
-        """模型初始化后的验证"""
+        self.num_images = self.num_images or 1
+        
         # 如果既没有natural_language也没有prompt，则报错
         if not self.natural_language and (not self.prompt or not self.prompt.strip()):
             raise ValueError("必须提供natural_language或prompt字段之一")
+        return self
 
 
 class GenerateResponse(BaseModel):
@@ -1,25 +1,28 @@
 """
 任务状态模型
 """
-from typing import Optional, Union, List
-from enum import Enum
+from typing import Optional, Union, List, Literal
 from datetime import datetime
 from dataclasses import dataclass, field
 
 
-class TaskStatus(str, Enum):
-    """任务状态枚举"""
-    PENDING = "pending"
-    PROCESSING = "processing"
-    COMPLETED = "completed"
-    FAILED = "failed"
+# 任务状态取值（用于类型标注）
+TaskStatusValue = Literal["pending", "processing", "completed", "failed"]
 
 
-@dataclass
+class TaskStatus:
+    """任务状态常量（直接使用字符串，无需Enum的.value转换）"""
+    PENDING: TaskStatusValue = "pending"
+    PROCESSING: TaskStatusValue = "processing"
+    COMPLETED: TaskStatusValue = "completed"
+    FAILED: TaskStatusValue = "failed"
+
+
+@dataclass(slots=True)
 class Task:
     """任务数据模型"""
     task_id: str
-    status: TaskStatus
+    status: TaskStatusValue
     created_at: datetime = field(default_factory=datetime.now)
     updated_at: datetime = field(default_factory=datetime.now)
     result_url: Optional[str] = None
@@ -29,7 +32,7 @@ class Task:
     prompt: Optional[str] = None
     negative_prompt: Optional[str] = None
     
-    def update_status(self, status: TaskStatus):
+    def update_status(self, status: TaskStatusValue):
         """更新任务状态"""
         self.status = status
         self.updated_at = datetime.now()
@@ -1,10 +1,11 @@
 """
 图片生成API路由
 """
-import uuid
-import asyncio
+import binascii
+from uuid import uuid4
 from typing import Optional
 from fastapi import APIRouter, Depends, BackgroundTasks, HTTPException
+from fastapi.responses import ORJSONResponse
 from app.models.schemas import GenerateRequest, GenerateResponse, TaskStatusResponse
 from app.models.task import TaskStatus
 from app.services.sd_service import SDService
@@ -12,12 +13,12 @@ from app.services.oss_service import OSSService
 from app.services.callback_service import CallbackService
 from app.services.llm_service import get_llm_service
 from app.utils.task_manager import task_manager
-from app.auth import require_auth
+from app.auth import AUTH_OPENAPI_EXTRA, require_auth
 from app.utils.logger import logger
+from app.utils.base64_utils import b64decode_data_uri
 from app.config import Config
-import gc
 
-router = APIRouter(prefix="/api/v1", tags=["image"])
+router = APIRouter(prefix="/api/v1", tags=["image"], default_response_class=ORJSONResponse)
 
 # 服务实例（全局单例）
 sd_service: Optional[SDService] = None
@@ -25,31 +26,40 @@ oss_service: Optional[OSSService] = None
 callback_service: Optional[CallbackService] = None
 
 
-def get_sd_service() -> SDService:
-    """获取SD服务实例（单例）"""
-    global sd_service
-    if sd_service is None:
+def init_services():
+    """在应用启动时创建所有服务实例（单例），之后的请求直接使用，无需再判断是否已创建"""
+    global sd_service, oss_service, callback_service
+    
+    try:
         sd_service = SDService()
+        logger.info("SD模型预加载完成")
+    except Exception as e:
+        logger.error("SD模型预加载失败: %s", e, exc_info=True)
+    
+    try:
+        oss_service = OSSService()
+    except Exception as e:
+        logger.error("OSS服务初始化失败: %s", e, exc_info=True)
+    
+    callback_service = CallbackService()
+
+
+def get_sd_service() -> Optional[SDService]:
+    """获取SD服务实例（单例，启动时由init_services创建）"""
     return sd_service
 
 
-def get_oss_service() -> OSSService:
-    """获取OSS服务实例（单例）"""
-    global oss_service
-    if oss_service is None:
-        oss_service = OSSService()
+def get_oss_service() -> Optional[OSSService]:
+    """获取OSS服务实例（单例，启动时由init_services创建）"""
     return oss_service
 
 
-def get_callback_service() -> CallbackService:
-    """获取回调服务实例（单例）"""
-    global callback_service
-    if callback_service is None:
-        callback_service = CallbackService()
+def get_callback_service() -> Optional[CallbackService]:
+    """获取回调服务实例（单例，启动时由init_services创建）"""
     return callback_service
 
 
-def cleanup_services():
+async def cleanup_services():
     """清理所有服务实例的资源"""
     global sd_service, oss_service, callback_service
     logger.info("开始清理服务实例...")
@@ -61,27 +71,27 @@ def cleanup_services():
             sd_service = None
             logger.info("SD服务已清理")
         except Exception as e:
-            logger.error(f"清理SD服务时出错: {e}", exc_info=True)
+            logger.error("清理SD服务时出错: %s", e, exc_info=True)
     
     if oss_service is not None:
         try:
-            # OSS服务通常不需要特殊清理，但可以删除引用
+            # 关闭上传线程池并删除引用
+            oss_service.cleanup()
             del oss_service
             oss_service = None
             logger.info("OSS服务已清理")
         except Exception as e:
-            logger.error(f"清理OSS服务时出错: {e}", exc_info=True)
+            logger.error("清理OSS服务时出错: %s", e, exc_info=True)
     
     if callback_service is not None:
         try:
+            # 等待尚未完成的回调推送（超时则放弃）并关闭连接
+            await callback_service.aclose()
             del callback_service
             callback_service = None
             logger.info("回调服务已清理")
         except Exception as e:
-            logger.error(f"清理回调服务时出错: {e}", exc_info=True)
-    
-    # 强制垃圾回收
-    gc.collect()
+            logger.error("清理回调服务时出错: %s", e, exc_info=True)
     
     logger.info("所有服务实例已清理")
 
@@ -89,7 +99,7 @@ def cleanup_services():
 async def generate_image_task(
     task_id: str,
     prompt: str,
-    init_image: Optional[str],
+    init_image: Optional[bytes],
     negative_prompt: Optional[str],
     num_images: int,
     scheduler: Optional[str],
@@ -108,7 +118,7 @@ async def generate_image_task(
     Args:
         task_id: 任务ID
         prompt: 提示词
-        init_image: 初始图片（base64）
+        init_image: 初始图片（已解码的二进制数据）
         negative_prompt: 负面提示词
         num_images: 生成图片张数
         scheduler: 采样方法
@@ -128,22 +138,23 @@ async def generate_image_task(
         sd_svc = get_sd_service()
         oss_svc = get_oss_service()
         cb_svc = get_callback_service()
+        if sd_svc is None or oss_svc is None:
+            raise RuntimeError("SD服务或OSS服务未初始化，请检查服务启动日志")
         
         # 如果用户手动提供了prompt（不是通过LLM转换），自动添加LoRA触发词
         # 注意：LLM转换的prompt已经在llm_service中添加了触发词
-        lora_trigger_words = Config.get_lora_trigger_words()
-        if lora_trigger_words and prompt:
-            prompt_lower = prompt.lower()
-            has_trigger = any(trigger.lower() in prompt_lower for trigger in lora_trigger_words)
+        trigger_str = Config.get_lora_trigger_str()
+        if trigger_str and prompt:
+            prompt_cf = prompt.casefold()
+            has_trigger = any(trigger in prompt_cf for trigger in Config.get_lora_trigger_words_casefold())
             if not has_trigger:
-                trigger_str = ", ".join(lora_trigger_words)
                 prompt = f"{trigger_str}, {prompt}"
-                logger.info(f"已自动为手动prompt添加LoRA触发词: {trigger_str}")
+                logger.info("已自动为手动prompt添加LoRA触发词: %s", trigger_str)
         
         # 根据是否有init_image决定生成方式
         if init_image:
             # 图生图
-            logger.info(f"开始图生图任务: task_id={task_id}, prompt={prompt[:50]}..., num_images={num_images}")
+            logger.info("开始图生图任务: task_id=%s, prompt=%s..., num_images=%s", task_id, prompt[:50], num_images)
             images = sd_svc.image_to_image(
                 prompt=prompt,
                 init_image=init_image,
@@ -155,10 +166,10 @@ async def generate_image_task(
                 guidance_scale=guidance_scale,
                 strength=strength,
             )
-            logger.info(f"图生图完成: task_id={task_id}, 生成图片数量={len(images) if isinstance(images, list) else 1}")
+            logger.info("图生图完成: task_id=%s, 生成图片数量=%s", task_id, len(images) if isinstance(images, list) else 1)
         else:
             # 文生图
-            logger.info(f"开始文生图任务: task_id={task_id}, prompt={prompt[:50]}..., num_images={num_images}, width={width}, height={height}")
+            logger.info("开始文生图任务: task_id=%s, prompt=%s..., num_images=%s, width=%s, height=%s", task_id, prompt[:50], num_images, width, height)
             images = sd_svc.text_to_image(
                 prompt=prompt,
                 negative_prompt=negative_prompt,
@@ -170,20 +181,20 @@ async def generate_image_task(
                 num_inference_steps=num_inference_steps,
                 guidance_scale=guidance_scale,
             )
-            logger.info(f"文生图完成: task_id={task_id}, 生成图片数量={len(images) if isinstance(images, list) else 1}")
+            logger.info("文生图完成: task_id=%s, 生成图片数量=%s", task_id, len(images) if isinstance(images, list) else 1)
         
         # 处理单张或多张图片
         if num_images == 1:
             # 单张图片：返回单个URL
             image = images[0] if isinstance(images, list) else images
-            logger.info(f"开始上传图片到OSS: task_id={task_id}, format={output_format}")
-            url = oss_svc.upload_image(image, output_format=output_format)
-            logger.info(f"图片生成成功: task_id={task_id}, url={url}")
+            logger.info("开始上传图片到OSS: task_id=%s, format=%s", task_id, output_format)
+            url = await oss_svc.upload_image_async(image, output_format=output_format)
+            logger.info("图片生成成功: task_id=%s, url=%s", task_id, url)
             task_manager.complete_task(task_id, url)
             
-            # 如果有回调URL，异步推送结果
+            # 如果有回调URL，异步推送结果（不等待推送完成）
             if callback_url:
-                await cb_svc.send_callback(
+                cb_svc.send_callback_nowait(
                     callback_url=callback_url,
                     task_id=task_id,
                     status="completed",
@@ -191,14 +202,14 @@ async def generate_image_task(
                 )
         else:
             # 多张图片：返回URL列表
-            logger.info(f"开始上传图片到OSS: task_id={task_id}, num_images={num_images}, format={output_format}")
-            urls = oss_svc.upload_images(images, output_format=output_format)
-            logger.info(f"图片生成成功: task_id={task_id}, num_images={len(urls)}, urls={urls}")
+            logger.info("开始上传图片到OSS: task_id=%s, num_images=%s, format=%s", task_id, num_images, output_format)
+            urls = await oss_svc.upload_images_async(images, output_format=output_format)
+            logger.info("图片生成成功: task_id=%s, num_images=%s, urls=%s", task_id, len(urls), urls)
             task_manager.complete_task(task_id, urls)
             
-            # 如果有回调URL，异步推送结果
+            # 如果有回调URL，异步推送结果（不等待推送完成）
             if callback_url:
-                await cb_svc.send_callback(
+                cb_svc.send_callback_nowait(
                     callback_url=callback_url,
                     task_id=task_id,
                     status="completed",
@@ -206,13 +217,13 @@ async def generate_image_task(
                 )
     except Exception as e:
         error_msg = str(e)
-        logger.error(f"图片生成失败: task_id={task_id}, error={error_msg}", exc_info=True)
+        logger.error("图片生成失败: task_id=%s, error=%s", task_id, error_msg, exc_info=True)
         task_manager.fail_task(task_id, error_msg)
         
         # 失败时也推送回调
-        if callback_url:
-            cb_svc = get_callback_service()
-            await cb_svc.send_callback(
+        cb_svc = get_callback_service()
+        if callback_url and cb_svc is not None:
+            cb_svc.send_callback_nowait(
                 callback_url=callback_url,
                 task_id=task_id,
                 status="failed",
@@ -220,7 +231,13 @@ async def generate_image_task(
             )
 
 
-@router.post("/generate", response_model=GenerateResponse, summary="图片生成接口")
+@router.post(
+    "/generate",
+    response_model=None,
+    responses={200: {"model": GenerateResponse}},  # 仅用于API文档，不对返回值做二次校验
+    openapi_extra=AUTH_OPENAPI_EXTRA,
+    summary="图片生成接口",
+)
 async def generate_image(
     request: GenerateRequest,
     background_tasks: BackgroundTasks,
@@ -234,6 +251,13 @@ async def generate_image(
     - 如果提供natural_language，将自动转换为prompt和negative_prompt
     - 返回task_id，任务将在后台异步执行
     """
+    # 超大图片在进入LLM/GPU处理前直接拒绝
+    if request.init_image and len(request.init_image) > Config.MAX_INIT_IMAGE_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"init_image过大，base64编码长度不能超过{Config.MAX_INIT_IMAGE_SIZE}",
+        )
+    
     # 处理自然语言转换
     prompt = request.prompt
     negative_prompt = request.negative_prompt
@@ -241,6 +265,15 @@ async def generate_image(
     # 判断是否为图生图任务
     is_img2img = bool(request.init_image and request.init_image.strip())
     
+    # 在入口处（LLM/SD处理之前）一次性解码init_image，无效的base64直接返回400；
+    # LLM识别与后台任务共用解码后的二进制数据（比base64字符串小约25%）
+    init_image_bytes = None
+    if is_img2img:
+        try:
+            init_image_bytes = b64decode_data_uri(request.init_image)
+        except (binascii.Error, ValueError):
+            raise HTTPException(status_code=400, detail="init_image不是有效的base64编码")
+    
     if request.natural_language:
         # 使用自然语言，需要转换为提示词
         llm_service = get_llm_service()
@@ -252,19 +285,19 @@ async def generate_image(
         
         try:
             task_type = "图生图" if is_img2img else "文生图"
-            logger.info(f"开始LLM转换 ({task_type}): natural_language='{request.natural_language[:50]}...'")
+            logger.info("开始LLM转换 (%s): natural_language='%s...'", task_type, request.natural_language[:50])
             
             # 如果是图生图且有原图，使用基于原图识别的方法
-            if is_img2img and request.init_image:
+            if is_img2img:
                 logger.info("使用基于原图识别的LLM转换方法，生成贴近原图的prompt")
-                converted_prompt, converted_negative_prompt = llm_service.convert_img2img_prompts_with_image(
+                converted_prompt, converted_negative_prompt = await llm_service.convert_img2img_prompts_with_image(
                     request.natural_language,
-                    request.init_image
+                    init_image_bytes
                 )
             else:
                 # 普通模式（文生图或没有原图的图生图）
-                converted_prompt, converted_negative_prompt = llm_service.convert_to_prompts(
-                    request.natural_language, 
+                converted_prompt, converted_negative_prompt = await llm_service.convert_to_prompts_coalesced(
+                    request.natural_language,
                     is_img2img=is_img2img
                 )
             
@@ -274,7 +307,7 @@ async def generate_image(
             if not negative_prompt or not negative_prompt.strip():
                 negative_prompt = converted_negative_prompt
             
-            logger.info(f"LLM转换完成 ({task_type}): prompt长度={len(prompt)}, negative_prompt长度={len(negative_prompt)}")
+            logger.info("LLM转换完成 (%s): prompt长度=%s, negative_prompt长度=%s", task_type, len(prompt), len(negative_prompt))
         except Exception as e:
             error_msg = f"自然语言转换失败: {str(e)}"
             logger.error(error_msg, exc_info=True)
@@ -285,7 +318,7 @@ async def generate_image(
         raise HTTPException(status_code=400, detail="必须提供prompt或natural_language字段")
     
     # 生成任务ID
-    task_id = str(uuid.uuid4())
+    task_id = uuid4().hex
     
     # 创建任务，保存prompt信息
     task_manager.create_task(
@@ -300,7 +333,7 @@ async def generate_image(
         generate_image_task,
         task_id=task_id,
         prompt=prompt,
-        init_image=request.init_image,
+        init_image=init_image_bytes,
         negative_prompt=negative_prompt,
         num_images=request.num_images or 1,
         scheduler=request.scheduler,
@@ -314,18 +347,25 @@ async def generate_image(
         callback_url=request.callback_url,
     )
     
-    return GenerateResponse(
+    # 响应字段均由服务端生成，可信，跳过构造时的校验
+    return GenerateResponse.model_construct(
         task_id=task_id,
         status="pending",
         message="任务已创建，正在处理中"
     )
 
 
-@router.get("/tasks/{task_id}", response_model=TaskStatusResponse, summary="查询任务状态")
+@router.get(
+    "/tasks/{task_id}",
+    response_model=None,
+    responses={200: {"model": TaskStatusResponse}},  # 仅用于API文档，不对返回值做二次校验
+    openapi_extra=AUTH_OPENAPI_EXTRA,
+    summary="查询任务状态",
+)
 async def get_task_status(
     task_id: str,
     api_key: str = Depends(require_auth),
-):
+) -> ORJSONResponse:
     """
     查询任务状态
     
@@ -336,17 +376,15 @@ async def get_task_status(
     if not task:
         raise HTTPException(status_code=404, detail="任务不存在")
     
-    # 构建响应
-    response_data = {
+    # 构建响应（数据来自内部任务管理器，可信，跳过Pydantic校验；orjson原生序列化datetime）
+    return ORJSONResponse({
         "task_id": task.task_id,
-        "status": task.status.value,
+        "status": task.status,
         "result_url": task.result_url,
         "result_urls": task.result_urls,
         "error_message": task.error_message,
         "prompt": task.prompt,
         "negative_prompt": task.negative_prompt,
-        "created_at": task.created_at.isoformat(),
-        "updated_at": task.updated_at.isoformat(),
-    }
-    
-    return TaskStatusResponse(**response_data)
+        "created_at": task.created_at,
+        "updated_at": task.updated_at,
+    })
@@ -2,12 +2,47 @@
 回调URL推送服务
 """
 import asyncio
+import functools
+import random
 import httpx
-from typing import Optional, List
+import orjson
+from typing import Any, Dict, Optional, List, Set, Tuple
 from urllib.parse import urlparse
 from app.config import Config
+from app.utils.http_utils import HTTP2_AVAILABLE
 from app.utils.logger import logger
 
+# 重试间隔上限（秒）
+RETRY_MAX_DELAY = 30.0
+
+# 可重试的4xx状态码（请求超时、请求过多），其余4xx为永久性错误，不再重试
+RETRYABLE_CLIENT_ERRORS = frozenset({408, 429})
+
+# 关闭服务时等待未完成推送的最长时间（秒）
+SHUTDOWN_TIMEOUT = 5.0
+
+# 批量推送：回调URL的队列空闲超过该时间（秒）后，推送任务退出并释放队列
+BATCH_IDLE_TIMEOUT = 60.0
+
+
+@functools.lru_cache(maxsize=512)
+def _validate_callback_url(url: str) -> Tuple[bool, str]:
+    """
+    校验回调URL格式（结果按URL缓存，回调方通常只有少数几个地址）
+    
+    Returns:
+        (是否有效, 无效原因)
+    """
+    try:
+        parsed = urlparse(url)
+    except ValueError as e:
+        return False, f"解析失败: {e}"
+    if not parsed.scheme or parsed.scheme not in ("http", "https"):
+        return False, "缺少协议"
+    if not parsed.netloc:
+        return False, "缺少域名"
+    return True, ""
+
 
 class CallbackService:
     """回调服务类"""
@@ -16,6 +51,73 @@ class CallbackService:
         """初始化回调服务"""
         self.retry_times = Config.CALLBACK_RETRY_TIMES
         self.retry_interval = Config.CALLBACK_RETRY_INTERVAL
+        # 限制同时进行的回调请求数，避免失败风暴时大量请求同时冲击回调方
+        self._semaphore = asyncio.Semaphore(Config.CALLBACK_MAX_CONCURRENCY or 32)
+        # 复用的HTTP客户端（首次推送时创建），保持连接以避免每次回调重新握手
+        self._client: Optional[httpx.AsyncClient] = None
+        # 后台进行的回调推送任务（保持引用，防止任务在完成前被垃圾回收）
+        self._pending: Set[asyncio.Task] = set()
+        # 关闭状态：_closing后不再接受新的通知，_closed后不再创建HTTP客户端
+        self._closing = False
+        self._closed = False
+        # 批量推送（可选）：每个活跃的回调URL一个队列和一个推送任务（空闲超时后释放）
+        self.batch_enabled = Config.CALLBACK_BATCH
+        self.batch_max_size = max(1, Config.CALLBACK_BATCH_MAX_SIZE)
+        self.batch_queue_size = Config.CALLBACK_BATCH_QUEUE_SIZE
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._consumers: Dict[str, asyncio.Task] = {}
+    
+    def _get_client(self) -> httpx.AsyncClient:
+        """获取复用的HTTP客户端（服务关闭后不再创建新的客户端）"""
+        if self._client is None or self._client.is_closed:
+            if self._closed:
+                raise RuntimeError("回调服务已关闭")
+            self._client = httpx.AsyncClient(
+                timeout=30.0,
+                limits=httpx.Limits(max_keepalive_connections=100, max_connections=200),
+                http2=HTTP2_AVAILABLE,  # HTTP/2下同一回调方的并发推送复用一个连接
+            )
+        return self._client
+    
+    async def aclose(self):
+        """等待未完成的推送（超时则放弃），关闭HTTP客户端，释放连接"""
+        self._closing = True
+        if self._pending:
+            _, not_done = await asyncio.wait(set(self._pending), timeout=SHUTDOWN_TIMEOUT)
+            if not_done:
+                # 超时仍未完成的推送直接取消，避免其在客户端关闭后继续重试
+                logger.warning("等待回调推送完成超时，取消剩余%s个推送", len(not_done))
+                for task in not_done:
+                    task.cancel()
+                await asyncio.gather(*not_done, return_exceptions=True)
+        if self._queues:
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(*(queue.join() for queue in self._queues.values())),
+                    timeout=SHUTDOWN_TIMEOUT,
+                )
+            except asyncio.TimeoutError:
+                logger.warning("等待批量回调推送完成超时，剩余通知将被丢弃")
+        for consumer in self._consumers.values():
+            consumer.cancel()
+        if self._consumers:
+            await asyncio.gather(*self._consumers.values(), return_exceptions=True)
+        self._consumers.clear()
+        self._queues.clear()
+        
+        self._closed = True
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    def send_callback_nowait(self, **kwargs: Any) -> None:
+        """在后台发送回调通知，不等待推送完成（参数同send_callback）"""
+        if self._closing:
+            logger.warning("回调服务已关闭，丢弃回调通知: task_id=%s", kwargs.get("task_id"))
+            return
+        task = asyncio.create_task(self.send_callback(**kwargs))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
     
     async def send_callback(
         self,
@@ -39,20 +141,13 @@ class CallbackService:
         """
         # 验证callback_url是否有效
         if not callback_url or not callback_url.strip():
-            logger.warning(f"回调URL为空，跳过推送: task_id={task_id}")
+            logger.warning("回调URL为空，跳过推送: task_id=%s", task_id)
             return
         
         # 检查URL格式
-        try:
-            parsed = urlparse(callback_url)
-            if not parsed.scheme or parsed.scheme not in ["http", "https"]:
-                logger.warning(f"回调URL格式无效（缺少协议）: task_id={task_id}, callback_url={callback_url}")
-                return
-            if not parsed.netloc:
-                logger.warning(f"回调URL格式无效（缺少域名）: task_id={task_id}, callback_url={callback_url}")
-                return
-        except Exception as e:
-            logger.warning(f"回调URL格式验证失败: task_id={task_id}, callback_url={callback_url}, error={e}")
+        ok, reason = _validate_callback_url(callback_url)
+        if not ok:
+            logger.warning("回调URL格式无效（%s）: task_id=%s, callback_url=%s", reason, task_id, callback_url)
             return
         
         # 构造回调数据
@@ -69,24 +164,92 @@ class CallbackService:
         elif status == "failed" and error_message:
             callback_data["error_message"] = error_message
         
-        # 重试推送
+        if self.batch_enabled:
+            self._enqueue(callback_url, task_id, callback_data)
+            return
+        
+        # 使用orjson预先序列化请求体，重试时复用
+        await self._post_with_retry(callback_url, orjson.dumps(callback_data), f"task_id={task_id}")
+    
+    def _enqueue(self, callback_url: str, task_id: str, callback_data: Dict[str, Any]):
+        """将通知放入回调URL对应的队列，必要时启动该URL的推送任务"""
+        queue = self._queues.get(callback_url)
+        if queue is None:
+            queue = asyncio.Queue(maxsize=self.batch_queue_size)
+            self._queues[callback_url] = queue
+            self._consumers[callback_url] = asyncio.create_task(self._consume(callback_url, queue))
+        try:
+            queue.put_nowait(callback_data)
+        except asyncio.QueueFull:
+            logger.error("回调队列已满，丢弃通知: task_id=%s, callback_url=%s", task_id, callback_url)
+    
+    async def _consume(self, callback_url: str, queue: asyncio.Queue):
+        """
+        持续取出队列中已积累的通知，合并为一个请求推送
+        
+        队列空闲超过BATCH_IDLE_TIMEOUT后退出并移除该URL的队列（callback_url由客户端提供，
+        常驻任务会随URL数量无限增长），之后该URL的新通知会重新创建队列和推送任务
+        """
+        while True:
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout=BATCH_IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                if not queue.empty():
+                    continue
+                # 检查与移除之间没有await，不会与_enqueue交错
+                self._queues.pop(callback_url, None)
+                self._consumers.pop(callback_url, None)
+                return
+            batch = [item]
+            try:
+                while len(batch) < self.batch_max_size:
+                    batch.append(queue.get_nowait())
+            except asyncio.QueueEmpty:
+                pass
+            try:
+                await self._post_with_retry(
+                    callback_url,
+                    orjson.dumps({"events": batch}),
+                    f"批量{len(batch)}条",
+                )
+            finally:
+                for _ in batch:
+                    queue.task_done()
+    
+    async def _post_with_retry(self, callback_url: str, content: bytes, desc: str):
+        """
+        推送已序列化的请求体，失败时按指数退避重试
+        
+        Args:
+            callback_url: 回调URL
+            content: JSON请求体
+            desc: 日志中标识本次推送的描述（如task_id）
+        """
+        client = self._get_client()
         for attempt in range(self.retry_times):
             try:
-                async with httpx.AsyncClient(timeout=30.0) as client:
+                async with self._semaphore:
                     response = await client.post(
                         callback_url,
-                        json=callback_data,
+                        content=content,
                         headers={"Content-Type": "application/json"}
                     )
-                    response.raise_for_status()
-                    logger.info(f"回调推送成功: task_id={task_id}, callback_url={callback_url}")
-                    return  # 成功则返回
+                response.raise_for_status()
+                logger.info("回调推送成功: %s, callback_url=%s", desc, callback_url)
+                return  # 成功则返回
             except Exception as e:
+                if isinstance(e, httpx.HTTPStatusError):
+                    status_code = e.response.status_code
+                    if 400 <= status_code < 500 and status_code not in RETRYABLE_CLIENT_ERRORS:
+                        logger.error("回调推送失败（HTTP %s，不再重试）: %s, callback_url=%s", status_code, desc, callback_url)
+                        return
                 if attempt < self.retry_times - 1:
-                    logger.warning(f"回调推送失败（尝试 {attempt + 1}/{self.retry_times}）: {e}, 将在{self.retry_interval}秒后重试")
-                    await asyncio.sleep(self.retry_interval)
+                    # 有上限的指数退避 + 随机抖动（0.5~1.5倍），避免大量失败回调同时重试
+                    delay = min(RETRY_MAX_DELAY, self.retry_interval * (2 ** attempt)) * (0.5 + random.random())
+                    logger.warning("回调推送失败（尝试 %s/%s）: %s, 将在%.2f秒后重试", attempt + 1, self.retry_times, e, delay)
+                    await asyncio.sleep(delay)
                 else:
-                    logger.error(f"回调推送最终失败: task_id={task_id}, callback_url={callback_url}, error={e}")
+                    logger.error("回调推送最终失败: %s, callback_url=%s, error=%s", desc, callback_url, e)
 
 
 # 全局回调服务实例
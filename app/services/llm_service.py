@@ -1,12 +1,150 @@
 """
 LLM服务模块：将自然语言转换为Stable Diffusion提示词
 """
+import asyncio
+import hashlib
+import re
+import threading
+import time
 import httpx
-import json
-from typing import Tuple, Optional
+import io
+import orjson
+from collections import OrderedDict
+from types import MappingProxyType
+from typing import Any, Dict, List, Mapping, Tuple, Optional, Union
+from PIL import Image
 from app.config import Config
+from app.services.semantic_cache import SemanticPromptCache
+from app.utils.base64_utils import base64, strip_data_uri
+from app.utils.http_utils import HTTP2_AVAILABLE
 from app.utils.logger import logger
 
+# 支持视觉输入的模型名称关键词（GPT-4V, Claude Vision, GLM, Qwen-VL等），按子串匹配、不区分大小写
+_VISION_MODEL_KEYWORDS = (
+    # OpenAI
+    "gpt-4-vision-preview", "gpt-4o", "gpt-4-turbo", "gpt-4-vision",
+    # Anthropic Claude
+    "claude-3-opus", "claude-3-sonnet", "claude-3-haiku", "claude-3.5-sonnet",
+    # GLM (智谱AI)
+    "glm-4v", "glm-4.6v", "glm-4-vision", "glm-4-flash-vision",
+    # Qwen (通义千问)
+    "qwen-vl", "qwen-vl-plus", "qwen-vl-max", "qwen2-vl",
+    # Gemini (Google)
+    "gemini-pro-vision", "gemini-1.5-pro", "gemini-1.5-flash",
+    # 其他常见视觉模型
+    "llava", "minigpt", "blip", "instructblip",
+    # 通用关键词：名称包含 "vision"、"vl"、"visual" 等也认为是视觉模型
+    "vision", "vl", "visual", "image", "multimodal",
+)
+_VISION_MODEL_RE = re.compile("|".join(map(re.escape, _VISION_MODEL_KEYWORDS)), re.IGNORECASE)
+
+# LLM输出的JSON结构（response_format为json_schema时使用）
+PROMPT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "prompt": {"type": "string"},
+        "negative_prompt": {"type": "string"},
+    },
+    "required": ["prompt", "negative_prompt"],
+    "additionalProperties": False,
+}
+
+# llm.response_format配置 -> 请求中的response_format
+_RESPONSE_FORMATS = {
+    "json_object": {"type": "json_object"},
+    "json_schema": {
+        "type": "json_schema",
+        "json_schema": {"name": "sd_prompt", "schema": PROMPT_SCHEMA, "strict": True},
+    },
+}
+
+# 缩小后的原图重新编码为JPEG时使用的质量
+VISION_IMAGE_JPEG_QUALITY = 90
+
+
+def _downscale_image(image: Union[str, bytes], max_dim: int) -> Optional[bytes]:
+    """
+    原图最长边超过max_dim时等比缩小并重新编码为JPEG（减少VL模型的图片token）
+    
+    Args:
+        image: 原图字节或base64编码（不含data:image前缀）
+        max_dim: 最长边上限（像素）
+    
+    Returns:
+        缩小后的JPEG字节；无需缩小或无法识别图片时返回None（按原图发送）
+    """
+    try:
+        raw = base64.b64decode(image) if isinstance(image, str) else image
+        with Image.open(io.BytesIO(raw)) as img:
+            if max(img.size) <= max_dim:
+                return None
+            img.thumbnail((max_dim, max_dim), Image.LANCZOS)
+            buffer = io.BytesIO()
+            img.convert("RGB").save(buffer, format="JPEG", quality=VISION_IMAGE_JPEG_QUALITY)
+            return buffer.getvalue()
+    except Exception as e:
+        logger.warning("缩小原图失败，按原图发送: %s", e)
+        return None
+
+
+# LLM未返回negative_prompt时使用的默认负面提示词（更全面）
+_DEFAULT_NEGATIVE_PROMPT = (
+    "lowres, bad anatomy, bad hands, text, error, missing fingers, extra digit, fewer digits, cropped, "
+    "worst quality, low quality, normal quality, jpeg artifacts, signature, watermark, username, blurry, "
+    "deformed, ugly, disfigured, bad proportions, malformed, mutated, extra limbs, missing limbs, "
+    "extra arms, extra legs, unnatural, unrealistic, distorted, out of focus, grainy, noise, "
+    "oversaturated, undersaturated, compression artifacts"
+)
+
+# LLM响应不是有效JSON时使用的负面提示词
+_SHORT_NEGATIVE_PROMPT = (
+    "lowres, bad anatomy, bad hands, text, error, missing fingers, extra digit, fewer digits, cropped, "
+    "worst quality, low quality, normal quality, jpeg artifacts, signature, watermark, username, blurry"
+)
+
+# LLM转换用到的提示词 (类别, 类型)，在LLMService初始化时一次性读取
+_PROMPT_KEYS = tuple(
+    (category, prompt_type)
+    for category in ("text2img", "img2img", "img2img_with_vision")
+    for prompt_type in ("system_prompt", "user_message_template")
+)
+
+# 温度不高于该值时LLM输出基本确定，才缓存LLM响应
+RESPONSE_CACHE_MAX_TEMPERATURE = 0.2
+
+
+class _JsonObjectScanner:
+    """增量扫描流式输出的文本，判断最外层JSON对象是否已经闭合（跳过字符串内的括号）"""
+    
+    __slots__ = ("depth", "started", "in_string", "escape")
+    
+    def __init__(self):
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escape = False
+    
+    def feed(self, text: str) -> bool:
+        """输入一段文本，最外层对象闭合时返回True"""
+        for ch in text:
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = self.started
+            elif ch == "{":
+                self.depth += 1
+                self.started = True
+            elif ch == "}" and self.started:
+                self.depth -= 1
+                if self.depth == 0:
+                    return True
+        return False
+
 
 class LLMService:
     """LLM服务类，用于将自然语言转换为提示词"""
@@ -19,34 +157,241 @@ class LLMService:
         self.temperature = Config.LLM_TEMPERATURE
         self.timeout = Config.LLM_TIMEOUT
         self.provider = Config.LLM_PROVIDER
+        self.stream = Config.LLM_STREAM
+        self._response_format = _RESPONSE_FORMATS.get(Config.LLM_RESPONSE_FORMAT, _RESPONSE_FORMATS["json_object"])
         
         # 图生图VL模型配置（可选）
         self.vision_model = Config.LLM_VISION_MODEL
         self.vision_api_base = Config.LLM_VISION_API_BASE
         self.vision_api_key = Config.LLM_VISION_API_KEY
+        self.vision_max_image_dim = Config.LLM_VISION_MAX_IMAGE_DIM
+        
+        # 预先拼接chat/completions接口地址（OpenAI及兼容API使用相同路径）
+        self._chat_url = f"{self.api_base}/chat/completions"
+        self._vision_chat_url = f"{self.vision_api_base or self.api_base}/chat/completions"
+        self._headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
+        }
+        self._vision_config = self._build_vision_config()
+        
+        # 提示词前缀（去除首尾空白，初始化时计算一次）
+        self._prefix = (Config.LLM_PROMPT_PREFIX or "").strip()
+        self._prefix_lower = self._prefix.lower()
+        self._prefix_concat = f"{self._prefix}, " if self._prefix else ""
+        
+        # 预先读取提示词配置，热路径中不再逐次查询Config
+        self._prompts: Dict[Tuple[str, str], Optional[str]] = {
+            key: Config.get_prompt(*key) for key in _PROMPT_KEYS
+        }
+        
+        # 系统提示词消息（按提示词缓存），保证每次请求的消息前缀字节一致，以命中服务商的提示词缓存
+        self._system_messages: Dict[str, dict] = {}
+        # 各任务类型共用的系统提示词前缀（可选，prompts.yaml中的common.system_prompt_prefix），
+        # 放在各自系统提示词之前，使不同任务类型的请求共享相同的前缀
+        self._common_system_prefix = (Config.get_prompt("common", "system_prompt_prefix") or "").strip()
+        
+        # 复用的HTTP客户端（连接池），避免每次调用LLM都重新建立TCP/TLS连接
+        # 超时在每次请求时单独指定（VL模型使用更长的超时）
+        self._client = httpx.AsyncClient(
+            timeout=self.timeout,
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+            http2=HTTP2_AVAILABLE,
+        )
+        
+        # 正在进行中的文本转换（键为 (自然语言, 是否图生图)），并发的相同请求共享同一次LLM调用
+        self._inflight_conversions: Dict[Tuple[str, bool], asyncio.Future] = {}
+        # 文本转换结果的LRU缓存（不含基于原图识别的转换，原图各不相同）
+        self.cache_size = Config.LLM_CACHE_SIZE
+        # 值为 (写入时间, 转换结果)，写入时间用于按llm.cache_ttl判断是否过期
+        self.cache_ttl = Config.LLM_CACHE_TTL
+        self._conversion_cache: "OrderedDict[Tuple[str, bool], Tuple[float, Tuple[str, str]]]" = OrderedDict()
+        # LLM响应的LRU缓存（键为请求内容的sha256，值为解析成功的 (prompt, negative_prompt)），
+        # 所有访问都在事件循环线程内，无需加锁
+        self.response_cache_size = Config.LLM_RESPONSE_CACHE_SIZE
+        self._response_cache: "OrderedDict[str, Tuple[str, str]]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0}
+        # 语义缓存（可选），文生图与图生图分开存放
+        self._semantic_caches: Dict[bool, SemanticPromptCache] = {}
+        if Config.LLM_SEMANTIC_CACHE_ENABLED:
+            self._semantic_caches = {
+                is_img2img: SemanticPromptCache(
+                    threshold=Config.LLM_SEMANTIC_CACHE_THRESHOLD,
+                    max_entries=Config.LLM_SEMANTIC_CACHE_MAX_ENTRIES,
+                )
+                for is_img2img in (False, True)
+            }
+    
+    async def aclose(self):
+        """关闭HTTP客户端，释放连接"""
+        await self._client.aclose()
     
-    def _get_vision_config(self):
-        """获取VL模型配置，如果未配置则使用普通模型配置"""
-        return {
+    def _response_cache_key(self, model: str, system_prompt: str, user_message: str, temperature: float) -> Optional[str]:
+        """计算LLM响应缓存的键；温度较高（输出不确定）或未启用缓存时返回None"""
+        if self.response_cache_size <= 0 or temperature > RESPONSE_CACHE_MAX_TEMPERATURE:
+            return None
+        raw = orjson.dumps(
+            {"m": model, "sp": system_prompt, "um": user_message, "t": temperature},
+            option=orjson.OPT_SORT_KEYS,
+        )
+        return hashlib.sha256(raw).hexdigest()
+    
+    def _lookup_response(self, key: Optional[str]) -> Optional[Tuple[str, str]]:
+        """查找LLM响应缓存，返回已解析的 (prompt, negative_prompt)，未命中或未启用时返回None"""
+        if key is None:
+            return None
+        cached = self._response_cache.get(key)
+        if cached is None:
+            self.stats["misses"] += 1
+            return None
+        self._response_cache.move_to_end(key)
+        self.stats["hits"] += 1
+        logger.info("命中LLM响应缓存")
+        return cached
+    
+    def _store_response(self, key: str, parsed: Tuple[str, str]):
+        """写入LLM响应缓存（仅限解析成功的结果），超出容量时淘汰最久未使用的条目"""
+        self._response_cache[key] = parsed
+        self._response_cache.move_to_end(key)
+        if len(self._response_cache) > self.response_cache_size:
+            self._response_cache.popitem(last=False)
+    
+    def _require_prompt(self, category: str, prompt_type: str) -> str:
+        """获取预先读取的提示词，缺失时抛出ValueError"""
+        prompt = self._prompts.get((category, prompt_type))
+        if not prompt:
+            raise ValueError(
+                f"提示词配置缺失：prompts.yaml 中未找到 {category}.{prompt_type}。"
+                f"请确保配置文件 {Config.PROMPTS_FILE} 存在且包含完整的提示词配置。"
+            )
+        return prompt
+    
+    def _system_message(self, system_prompt: str) -> dict:
+        """
+        构建系统提示词消息
+        
+        系统提示词固定放在消息列表最前面，作为服务商自动提示词缓存的公共前缀（配置了公共前缀时在最前面）；
+        provider为anthropic时按片段发送并添加cache_control标记，显式启用提示词缓存
+        """
+        message = self._system_messages.get(system_prompt)
+        if message is None:
+            fragments = [self._common_system_prefix, system_prompt] if self._common_system_prefix else [system_prompt]
+            if self.provider == "anthropic":
+                content = [
+                    {"type": "text", "text": fragment, "cache_control": {"type": "ephemeral"}}
+                    for fragment in fragments
+                ]
+            else:
+                content = "\n\n".join(fragments)
+            message = {"role": "system", "content": content}
+            self._system_messages[system_prompt] = message
+        return message
+    
+    def _add_prompt_cache_key(self, payload: dict, prompt_cache_key: Optional[str]):
+        """provider为openai时在请求体中添加prompt_cache_key，使相同系统提示词的请求路由到同一缓存（其他兼容API可能不支持该字段）"""
+        if prompt_cache_key and self.provider == "openai":
+            payload["prompt_cache_key"] = prompt_cache_key
+    
+    async def _embed(self, text: str) -> Optional[list]:
+        """通过/embeddings接口计算文本向量，失败时返回None（不影响正常转换）"""
+        try:
+            response = await self._client.post(
+                f"{self.api_base}/embeddings",
+                json={"model": Config.LLM_SEMANTIC_CACHE_EMBEDDING_MODEL, "input": text},
+                headers={"Authorization": f"Bearer {self.api_key}"},
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+            return orjson.loads(response.content)["data"][0]["embedding"]
+        except Exception as e:
+            logger.warning("计算文本向量失败，跳过语义缓存: %s", e)
+            return None
+    
+    def _build_vision_config(self) -> Mapping[str, Any]:
+        """构建VL模型配置（只读），如果未配置则使用普通模型配置"""
+        return MappingProxyType({
             "api_base": self.vision_api_base or self.api_base,
+            "chat_url": self._vision_chat_url,
             "api_key": self.vision_api_key or self.api_key,
+            "headers": {
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {self.vision_api_key or self.api_key}"
+            },
             "model": self.vision_model or self.model,
             "provider": self.provider,
             "temperature": self.temperature,
             "timeout": self.timeout * 2  # VL模型需要更长时间
-        }
+        })
+    
+    def _get_vision_config(self) -> Mapping[str, Any]:
+        """获取VL模型配置（初始化时构建）"""
+        return self._vision_config
     
-    def convert_img2img_prompts_with_image(
+    async def _prepare_vision_image(self, init_image: Union[str, bytes]) -> str:
+        """
+        得到发送给VL模型的原图base64编码（不含data:image前缀）
+        
+        原图过大时先缩小，图片token随像素数增长（在线程中处理，不阻塞事件循环）
+        """
+        # 移除data:image前缀
+        image_data = None if isinstance(init_image, bytes) else strip_data_uri(init_image)
+        
+        if self.vision_max_image_dim > 0:
+            downscaled = await asyncio.to_thread(
+                _downscale_image,
+                init_image if image_data is None else image_data,
+                self.vision_max_image_dim,
+            )
+            if downscaled is not None:
+                return base64.b64encode(downscaled).decode("ascii")
+        if image_data is None:
+            image_data = base64.b64encode(init_image).decode("ascii")
+        return image_data
+    
+    @staticmethod
+    def _build_vision_messages(user_message_template: str, natural_language: str, image_data: str) -> list:
+        """构建VL模型的用户消息（文本 + 原图）"""
+        return [
+            {
+                "type": "text",
+                "text": user_message_template.format(natural_language=natural_language)
+            },
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:image/jpeg;base64,{image_data}"
+                }
+            }
+        ]
+    
+    def _postprocess_prompt(self, prompt: str) -> str:
+        """为LLM生成的prompt添加LoRA触发词和配置的前缀"""
+        # 添加LoRA触发词（优先，放在最前面）
+        trigger_str = Config.get_lora_trigger_str()
+        if trigger_str:
+            # 检查提示词中是否已包含触发词（避免重复）
+            prompt_cf = prompt.casefold()
+            has_trigger = any(trigger in prompt_cf for trigger in Config.get_lora_trigger_words_casefold())
+            if not has_trigger:
+                prompt = f"{trigger_str}, {prompt}"
+                logger.info("已自动添加LoRA触发词: %s", trigger_str)
+        
+        # 添加配置的前缀（在触发词之后），前缀已包含在提示词中时不重复添加
+        if self._prefix and self._prefix_lower not in prompt.lower():
+            prompt = self._prefix_concat + prompt
+        return prompt
+    
+    async def convert_img2img_prompts_with_image(
         self, 
         natural_language: str, 
-        init_image_base64: str
+        init_image: Union[str, bytes]
     ) -> Tuple[str, str]:
         """
         基于原图内容识别，将自然语言转换为贴近原图的Stable Diffusion图生图提示词
         
         Args:
             natural_language: 用户的修改要求（如"将衣服变成白色，去掉反光效果"）
-            init_image_base64: 原图的base64编码
+            init_image: 原图的base64编码（可带data:image前缀）或原图字节
             
         Returns:
             (prompt, negative_prompt) 元组
@@ -58,111 +403,119 @@ class LLMService:
         vision_config = self._get_vision_config()
         vision_model = vision_config["model"]
         
-        # 检查模型是否支持视觉输入（GPT-4V, Claude Vision, GLM, Qwen-VL等）
-        vision_models = [
-            # OpenAI
-            "gpt-4-vision-preview", "gpt-4o", "gpt-4-turbo", "gpt-4-vision",
-            # Anthropic Claude
-            "claude-3-opus", "claude-3-sonnet", "claude-3-haiku", "claude-3.5-sonnet",
-            # GLM (智谱AI)
-            "glm-4v", "glm-4.6v", "glm-4-vision", "glm-4-flash-vision",
-            # Qwen (通义千问)
-            "qwen-vl", "qwen-vl-plus", "qwen-vl-max", "qwen2-vl",
-            # Gemini (Google)
-            "gemini-pro-vision", "gemini-1.5-pro", "gemini-1.5-flash",
-            # 其他常见视觉模型
-            "llava", "minigpt", "blip", "instructblip"
-        ]
-        # 检查模型名称是否包含任何视觉模型关键词
-        vision_model_lower = vision_model.lower()
-        is_vision_model = any(vm in vision_model_lower for vm in vision_models)
-        
-        # 额外检查：如果模型名称包含 "vision" 或 "vl" 或 "visual"，也认为是视觉模型
-        if not is_vision_model:
-            vision_keywords = ["vision", "vl", "visual", "image", "multimodal"]
-            is_vision_model = any(keyword in vision_model_lower for keyword in vision_keywords)
+        # 检查模型是否支持视觉输入（模型名称包含任一视觉模型关键词）
+        is_vision_model = _VISION_MODEL_RE.search(vision_model) is not None
         
         if not is_vision_model:
             # 如果不支持视觉，回退到普通模式
-            logger.warning(f"VL模型 {vision_model} 不支持视觉输入，回退到普通图生图模式")
-            return self.convert_to_prompts(natural_language, is_img2img=True)
+            logger.warning("VL模型 %s 不支持视觉输入，回退到普通图生图模式", vision_model)
+            return await self.convert_to_prompts(natural_language, is_img2img=True)
         
         # 使用VL模型配置
-        logger.info(f"使用VL模型进行原图识别: {vision_model}")
+        logger.info("使用VL模型进行原图识别: %s", vision_model)
         
         try:
-            # 从配置文件加载提示词
-            system_prompt = Config.get_prompt("img2img_with_vision", "system_prompt")
-            if not system_prompt:
-                raise ValueError(
-                    f"提示词配置缺失：prompts.yaml 中未找到 img2img_with_vision.system_prompt。"
-                    f"请确保配置文件 {Config.PROMPTS_FILE} 存在且包含完整的提示词配置。"
-                )
-            
-            user_message_template = Config.get_prompt("img2img_with_vision", "user_message_template")
-            if not user_message_template:
-                raise ValueError(
-                    f"提示词配置缺失：prompts.yaml 中未找到 img2img_with_vision.user_message_template。"
-                    f"请确保配置文件 {Config.PROMPTS_FILE} 存在且包含完整的提示词配置。"
-                )
-
-            # 处理base64图片（移除data:image前缀）
-            image_data = init_image_base64
-            if "," in init_image_base64:
-                image_data = init_image_base64.split(",")[1]
+            # 提示词（初始化时从配置文件加载）
+            system_prompt = self._require_prompt("img2img_with_vision", "system_prompt")
+            user_message_template = self._require_prompt("img2img_with_vision", "user_message_template")
             
-            # 构建消息（使用模板格式化）
-            user_message_text = user_message_template.format(natural_language=natural_language)
-            
-            # 构建消息
-            user_message = [
-                {
-                    "type": "text",
-                    "text": user_message_text
-                },
-                {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/jpeg;base64,{image_data}"
-                    }
-                }
-            ]
+            # 构建消息（原图过大时先缩小）
+            image_data = await self._prepare_vision_image(init_image)
+            user_message = self._build_vision_messages(user_message_template, natural_language, image_data)
             
             # 调用LLM API（支持视觉的模型）
-            response = self._call_llm_api_with_vision(system_prompt, user_message, vision_config)
+            response = await self._call_llm_api_with_vision(
+                system_prompt, user_message, vision_config, prompt_cache_key="sd-img2img_with_vision"
+            )
             
-            # 解析响应
-            prompt, negative_prompt = self._parse_response(response)
+            # 解析响应，添加LoRA触发词和前缀
+            prompt, negative_prompt, _ = self._parse_response(response)
+            prompt = self._postprocess_prompt(prompt)
             
-            # 添加LoRA触发词（优先，放在最前面）
-            lora_trigger_words = Config.get_lora_trigger_words()
-            if lora_trigger_words:
-                trigger_str = ", ".join(lora_trigger_words)
-                # 检查提示词中是否已包含触发词（避免重复）
-                prompt_lower = prompt.lower()
-                has_trigger = any(trigger.lower() in prompt_lower for trigger in lora_trigger_words)
-                if not has_trigger:
-                    prompt = f"{trigger_str}, {prompt}"
-                    logger.info(f"已自动添加LoRA触发词: {trigger_str}")
-            
-            # 添加配置的前缀（在触发词之后）
-            if Config.LLM_PROMPT_PREFIX:
-                prefix = Config.LLM_PROMPT_PREFIX.strip()
-                if prefix:
-                    # 检查前缀是否已包含在提示词中
-                    if prefix.lower() not in prompt.lower():
-                        prompt = f"{prefix}, {prompt}"
-            
-            logger.info(f"基于原图识别的LLM转换成功: 用户要求='{natural_language[:50]}...' -> prompt长度={len(prompt)}")
+            logger.info("基于原图识别的LLM转换成功: 用户要求='%s...' -> prompt长度=%s", natural_language[:50], len(prompt))
             return prompt, negative_prompt
             
         except Exception as e:
-            logger.error(f"基于原图识别的LLM转换失败: {str(e)}", exc_info=True)
+            logger.error("基于原图识别的LLM转换失败: %s", e, exc_info=True)
             # 如果失败，回退到普通模式
             logger.warning("回退到普通图生图模式")
-            return self.convert_to_prompts(natural_language, is_img2img=True)
+            return await self.convert_to_prompts(natural_language, is_img2img=True)
+    
+    async def convert_to_prompts_coalesced(self, natural_language: str, is_img2img: bool = False) -> Tuple[str, str]:
+        """
+        将自然语言转换为Stable Diffusion提示词
+        
+        并发到达的相同请求会合并为一次LLM调用，共享转换结果；
+        转换结果按 (自然语言, 是否图生图) 缓存（LRU，大小由llm.cache_size配置，有效期由llm.cache_ttl配置）；
+        启用llm.semantic_cache时，语义相近的输入也复用已有结果
+        
+        Args:
+            natural_language: 自然语言描述
+            is_img2img: 是否为图生图任务，默认为False（文生图）
+            
+        Returns:
+            (prompt, negative_prompt) 元组
+        """
+        key = (natural_language, is_img2img)
+        cached = self._conversion_cache.get(key)
+        if cached is not None:
+            stored_at, result = cached
+            if self.cache_ttl <= 0 or time.monotonic() - stored_at < self.cache_ttl:
+                self._conversion_cache.move_to_end(key)
+                logger.info("命中LLM转换缓存")
+                return result
+            del self._conversion_cache[key]
+        
+        future = self._inflight_conversions.get(key)
+        semantic_cache = self._semantic_caches.get(is_img2img)
+        embedding = None
+        if future is None and semantic_cache is not None:
+            embedding = await self._embed(natural_language)
+            if embedding is not None:
+                result = semantic_cache.lookup(embedding)
+                if result is not None:
+                    logger.info("命中LLM转换语义缓存")
+                    return result
+            # 计算向量期间可能已有相同请求发起了转换
+            future = self._inflight_conversions.get(key)
+        
+        if future is None:
+            future = asyncio.ensure_future(self._convert_to_prompts(natural_language, is_img2img))
+            self._inflight_conversions[key] = future
+            future.add_done_callback(lambda _: self._inflight_conversions.pop(key, None))
+        else:
+            logger.info("相同的LLM转换请求正在进行中，共享其结果")
+        # shield：单个请求被取消时不影响其他等待同一结果的请求
+        result, cacheable = await asyncio.shield(future)
+        
+        # LLM响应不是有效JSON时的降级结果不写入缓存，避免之后相同输入一直得到该结果
+        if not cacheable:
+            return result
+        if embedding is not None:
+            semantic_cache.add(embedding, result)
+        if self.cache_size > 0:
+            self._conversion_cache[key] = (time.monotonic(), result)
+            self._conversion_cache.move_to_end(key)
+            if len(self._conversion_cache) > self.cache_size:
+                self._conversion_cache.popitem(last=False)
+        return result
     
-    def convert_to_prompts(self, natural_language: str, is_img2img: bool = False) -> Tuple[str, str]:
+    async def convert_many(self, natural_languages: List[str], is_img2img: bool = False) -> List[Tuple[str, str]]:
+        """
+        并发转换多条自然语言（共享连接池、缓存与相同请求合并）
+        
+        Args:
+            natural_languages: 自然语言描述列表
+            is_img2img: 是否为图生图任务，默认为False（文生图）
+            
+        Returns:
+            与输入顺序一致的 (prompt, negative_prompt) 元组列表
+        """
+        return list(await asyncio.gather(
+            *(self.convert_to_prompts_coalesced(text, is_img2img) for text in natural_languages)
+        ))
+    
+    async def convert_to_prompts(self, natural_language: str, is_img2img: bool = False) -> Tuple[str, str]:
         """
         将自然语言转换为Stable Diffusion提示词
         
@@ -173,79 +526,56 @@ class LLMService:
         Returns:
             (prompt, negative_prompt) 元组
         """
+        result, _ = await self._convert_to_prompts(natural_language, is_img2img)
+        return result
+    
+    async def _convert_to_prompts(self, natural_language: str, is_img2img: bool) -> Tuple[Tuple[str, str], bool]:
+        """
+        将自然语言转换为Stable Diffusion提示词，并返回结果是否可以缓存
+        
+        Returns:
+            ((prompt, negative_prompt), 是否可缓存)；LLM响应不是有效JSON而使用降级结果时不可缓存
+        """
         if not self.api_key or not self.api_base:
             raise ValueError("LLM服务未配置，请在config.yaml中配置llm.api_key和llm.api_base")
         
         try:
-            # 根据任务类型构建不同的system_prompt
-            if is_img2img:
-                # 图生图任务的system_prompt（从配置文件加载）
-                system_prompt = Config.get_prompt("img2img", "system_prompt")
-                if not system_prompt:
-                    raise ValueError(
-                        f"提示词配置缺失：prompts.yaml 中未找到 img2img.system_prompt。"
-                        f"请确保配置文件 {Config.PROMPTS_FILE} 存在且包含完整的提示词配置。"
-                    )
-                
-                user_message_template = Config.get_prompt("img2img", "user_message_template")
-                if not user_message_template:
-                    raise ValueError(
-                        f"提示词配置缺失：prompts.yaml 中未找到 img2img.user_message_template。"
-                        f"请确保配置文件 {Config.PROMPTS_FILE} 存在且包含完整的提示词配置。"
-                    )
-                
-                user_message = user_message_template.format(natural_language=natural_language)
-            else:
-                # 文生图任务的system_prompt（从配置文件加载）
-                system_prompt = Config.get_prompt("text2img", "system_prompt")
-                if not system_prompt:
-                    raise ValueError(
-                        f"提示词配置缺失：prompts.yaml 中未找到 text2img.system_prompt。"
-                        f"请确保配置文件 {Config.PROMPTS_FILE} 存在且包含完整的提示词配置。"
-                    )
-                
-                user_message_template = Config.get_prompt("text2img", "user_message_template")
-                if not user_message_template:
-                    raise ValueError(
-                        f"提示词配置缺失：prompts.yaml 中未找到 text2img.user_message_template。"
-                        f"请确保配置文件 {Config.PROMPTS_FILE} 存在且包含完整的提示词配置。"
-                    )
-                
-                user_message = user_message_template.format(natural_language=natural_language)
+            # 根据任务类型选择提示词（初始化时从配置文件加载）
+            category = "img2img" if is_img2img else "text2img"
+            system_prompt = self._require_prompt(category, "system_prompt")
+            user_message_template = self._require_prompt(category, "user_message_template")
+            user_message = user_message_template.format(natural_language=natural_language)
             
-            # 调用LLM API
-            response = self._call_llm_api(system_prompt, user_message)
-            
-            # 解析响应
-            prompt, negative_prompt = self._parse_response(response)
-            
-            # 添加LoRA触发词（优先，放在最前面）
-            lora_trigger_words = Config.get_lora_trigger_words()
-            if lora_trigger_words:
-                trigger_str = ", ".join(lora_trigger_words)
-                # 检查提示词中是否已包含触发词（避免重复）
-                prompt_lower = prompt.lower()
-                has_trigger = any(trigger.lower() in prompt_lower for trigger in lora_trigger_words)
-                if not has_trigger:
-                    prompt = f"{trigger_str}, {prompt}"
-                    logger.info(f"已自动添加LoRA触发词: {trigger_str}")
+            # 低温度时先查LLM响应缓存，未命中再调用LLM API
+            cache_key = self._response_cache_key(self.model, system_prompt, user_message, self.temperature)
+            cached = self._lookup_response(cache_key)
+            if cached is not None:
+                prompt, negative_prompt = cached
+                is_json = True
+            else:
+                response = await self._call_llm_api(system_prompt, user_message, prompt_cache_key=f"sd-{category}")
+                # 解析响应，只有解析成功的结果才写入响应缓存
+                prompt, negative_prompt, is_json = self._parse_response(response)
+                if is_json and cache_key is not None:
+                    self._store_response(cache_key, (prompt, negative_prompt))
             
-            # 添加配置的前缀（在触发词之后）
-            if Config.LLM_PROMPT_PREFIX:
-                prefix = Config.LLM_PROMPT_PREFIX.strip()
-                if prefix:
-                    # 检查前缀是否已包含在提示词中
-                    if prefix.lower() not in prompt.lower():
-                        prompt = f"{prefix}, {prompt}"
+            # 添加LoRA触发词和前缀
+            prompt = self._postprocess_prompt(prompt)
             
-            logger.info(f"LLM转换成功: 自然语言='{natural_language[:50]}...' -> prompt长度={len(prompt)}")
-            return prompt, negative_prompt
+            logger.info("LLM转换成功: 自然语言='%s...' -> prompt长度=%s", natural_language[:50], len(prompt))
+            return (prompt, negative_prompt), is_json
             
         except Exception as e:
-            logger.error(f"LLM转换失败: {str(e)}", exc_info=True)
+            logger.error("LLM转换失败: %s", e, exc_info=True)
             raise
     
-    def _call_llm_api_with_vision(self, system_prompt: str, user_message: list, vision_config: dict = None) -> str:
+    async def _call_llm_api_with_vision(
+        self,
+        system_prompt: str,
+        user_message: list,
+        vision_config: Optional[Mapping[str, Any]] = None,
+        prompt_cache_key: Optional[str] = None
+    ) -> str:
         """
         调用支持视觉的LLM API（用于图片内容识别）
         
@@ -253,6 +583,7 @@ class LLMService:
             system_prompt: 系统提示词
             user_message: 用户消息（包含文本和图片）
             vision_config: VL模型配置（如果为None，使用默认配置）
+            prompt_cache_key: 提示词缓存键（同一任务类型的请求使用相同的键）
             
         Returns:
             LLM响应的文本内容
@@ -261,96 +592,121 @@ class LLMService:
         if vision_config is None:
             vision_config = self._get_vision_config()
         
-        api_base = vision_config["api_base"]
-        api_key = vision_config["api_key"]
+        url = vision_config["chat_url"]
         model = vision_config["model"]
         temperature = vision_config["temperature"]
         timeout = vision_config["timeout"]
-        provider = vision_config["provider"]
-        
-        # 构建请求URL
-        if provider == "openai" or api_base.endswith("/v1"):
-            url = f"{api_base}/chat/completions"
-        else:
-            url = f"{api_base}/chat/completions"
         
         # 构建请求体
         payload = {
             "model": model,
             "messages": [
-                {"role": "system", "content": system_prompt},
+                self._system_message(system_prompt),
                 {"role": "user", "content": user_message}
             ],
             "temperature": temperature,
-            "response_format": {"type": "json_object"}  # 强制JSON格式
+            "response_format": self._response_format  # 强制JSON格式
         }
+        self._add_prompt_cache_key(payload, prompt_cache_key)
         
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
-        }
+        headers = vision_config["headers"]
         
         # 发送请求
-        with httpx.Client(timeout=timeout) as client:
-            response = client.post(url, json=payload, headers=headers)
-            response.raise_for_status()
-            result = response.json()
-            
-            # 提取内容
-            if "choices" in result and len(result["choices"]) > 0:
-                content = result["choices"][0]["message"]["content"]
-                return content
-            else:
-                raise ValueError(f"LLM API响应格式异常: {result}")
+        # 使用orjson序列化请求体（包含base64图片，体积较大）
+        response = await self._client.post(url, content=orjson.dumps(payload), headers=headers, timeout=timeout)
+        response.raise_for_status()
+        result = orjson.loads(response.content)
+        
+        # 提取内容
+        if "choices" in result and len(result["choices"]) > 0:
+            content = result["choices"][0]["message"]["content"]
+            return content
+        else:
+            raise ValueError(f"LLM API响应格式异常: {result}")
     
-    def _call_llm_api(self, system_prompt: str, user_message: str) -> str:
+    async def _call_llm_api(self, system_prompt: str, user_message: str, prompt_cache_key: Optional[str] = None) -> str:
         """
         调用LLM API
         
         Args:
             system_prompt: 系统提示词
             user_message: 用户消息
+            prompt_cache_key: 提示词缓存键（同一任务类型的请求使用相同的键）
             
         Returns:
             LLM响应的文本内容
         """
-        # 构建请求URL
-        if self.provider == "openai" or self.api_base.endswith("/v1"):
-            url = f"{self.api_base}/chat/completions"
-        else:
-            # 兼容其他OpenAI兼容的API
-            url = f"{self.api_base}/chat/completions"
+        url = self._chat_url
         
         # 构建请求体
         payload = {
             "model": self.model,
             "messages": [
-                {"role": "system", "content": system_prompt},
+                self._system_message(system_prompt),
                 {"role": "user", "content": user_message}
             ],
             "temperature": self.temperature,
-            "response_format": {"type": "json_object"}  # 强制JSON格式
+            "response_format": self._response_format  # 强制JSON格式
         }
+        self._add_prompt_cache_key(payload, prompt_cache_key)
         
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
+        headers = self._headers
         
         # 发送请求
-        with httpx.Client(timeout=self.timeout) as client:
-            response = client.post(url, json=payload, headers=headers)
+        if self.stream:
+            content = await self._stream_chat(url, payload, headers, self.timeout)
+        else:
+            response = await self._client.post(url, content=orjson.dumps(payload), headers=headers, timeout=self.timeout)
             response.raise_for_status()
-            result = response.json()
+            result = orjson.loads(response.content)
             
             # 提取内容
             if "choices" in result and len(result["choices"]) > 0:
                 content = result["choices"][0]["message"]["content"]
-                return content
             else:
                 raise ValueError(f"LLM API响应格式异常: {result}")
+        
+        return content
     
-    def _parse_response(self, response_text: str) -> Tuple[str, str]:
+    async def _stream_chat(self, url: str, payload: dict, headers: dict, timeout: float) -> str:
+        """
+        以流式（SSE）方式调用chat/completions接口，累积增量内容
+        
+        输出的JSON对象一闭合就不再解析和累积后续内容，但仍读完剩余的流：
+        提前关闭响应会使httpx丢弃该连接，下次调用需要重新建立TCP/TLS连接
+        
+        Returns:
+            LLM响应的文本内容
+        """
+        payload["stream"] = True
+        parts = []
+        scanner = _JsonObjectScanner()
+        complete = False
+        async with self._client.stream(
+            "POST", url, content=orjson.dumps(payload), headers=headers, timeout=timeout
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                # JSON已完整：只读完剩余的流（通常只有结束块和[DONE]），使连接可以放回连接池复用
+                if complete or not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                choices = orjson.loads(data).get("choices")
+                if not choices:
+                    continue
+                delta = (choices[0].get("delta") or {}).get("content")
+                if not delta:
+                    continue
+                parts.append(delta)
+                complete = scanner.feed(delta)
+        
+        if not parts:
+            raise ValueError("LLM API流式响应中没有内容")
+        return "".join(parts)
+    
+    def _parse_response(self, response_text: str) -> Tuple[str, str, bool]:
         """
         解析LLM响应，提取prompt和negative_prompt
         
@@ -358,21 +714,28 @@ class LLMService:
             response_text: LLM响应的文本内容
             
         Returns:
-            (prompt, negative_prompt) 元组
+            (prompt, negative_prompt, 是否为有效JSON) 元组；
+            响应不是有效JSON时以原始文本作为prompt（降级结果，调用方不应缓存）
         """
         try:
-            # 尝试解析JSON
-            # 如果响应包含markdown代码块，先提取JSON部分
-            if "```json" in response_text:
-                json_start = response_text.find("```json") + 7
-                json_end = response_text.find("```", json_start)
-                response_text = response_text[json_start:json_end].strip()
-            elif "```" in response_text:
-                json_start = response_text.find("```") + 3
-                json_end = response_text.find("```", json_start)
-                response_text = response_text[json_start:json_end].strip()
-            
-            data = json.loads(response_text)
+            # 请求使用了 response_format=json_object，响应通常就是纯JSON，直接解析
+            try:
+                data = orjson.loads(response_text)
+            except orjson.JSONDecodeError:
+                # 如果响应包含markdown代码块，先提取JSON部分再解析
+                if "```json" in response_text:
+                    json_start = response_text.find("```json") + 7
+                    json_end = response_text.find("```", json_start)
+                    # 流式读取在JSON闭合时提前结束，结尾的```可能不存在
+                    response_text = response_text[json_start:json_end if json_end >= 0 else None].strip()
+                elif "```" in response_text:
+                    json_start = response_text.find("```") + 3
+                    json_end = response_text.find("```", json_start)
+                    # 流式读取在JSON闭合时提前结束，结尾的```可能不存在
+                    response_text = response_text[json_start:json_end if json_end >= 0 else None].strip()
+                else:
+                    raise
+                data = orjson.loads(response_text)
             
             prompt = data.get("prompt", "")
             negative_prompt = data.get("negative_prompt", "")
@@ -382,24 +745,25 @@ class LLMService:
             
             # 如果没有negative_prompt，使用默认值（更全面的负面提示词）
             if not negative_prompt:
-                negative_prompt = "lowres, bad anatomy, bad hands, text, error, missing fingers, extra digit, fewer digits, cropped, worst quality, low quality, normal quality, jpeg artifacts, signature, watermark, username, blurry, deformed, ugly, disfigured, bad proportions, malformed, mutated, extra limbs, missing limbs, extra arms, extra legs, unnatural, unrealistic, distorted, out of focus, grainy, noise, oversaturated, undersaturated, compression artifacts"
+                negative_prompt = _DEFAULT_NEGATIVE_PROMPT
             
-            return prompt, negative_prompt
+            return prompt, negative_prompt, True
             
-        except json.JSONDecodeError as e:
-            logger.warning(f"LLM响应不是有效的JSON，尝试提取文本: {e}")
+        except orjson.JSONDecodeError as e:
+            logger.warning("LLM响应不是有效的JSON，尝试提取文本: %s", e)
             # 如果JSON解析失败，尝试简单提取
             # 假设格式是 "prompt: ..." 或 "negative_prompt: ..."
             prompt = response_text
-            negative_prompt = "lowres, bad anatomy, bad hands, text, error, missing fingers, extra digit, fewer digits, cropped, worst quality, low quality, normal quality, jpeg artifacts, signature, watermark, username, blurry"
-            return prompt, negative_prompt
+            negative_prompt = _SHORT_NEGATIVE_PROMPT
+            return prompt, negative_prompt, False
         except Exception as e:
-            logger.error(f"解析LLM响应失败: {e}")
+            logger.error("解析LLM响应失败: %s", e)
             raise ValueError(f"无法解析LLM响应: {str(e)}")
 
 
 # 全局LLM服务实例
 _llm_service: Optional[LLMService] = None
+_llm_lock = threading.Lock()
 
 
 def get_llm_service() -> Optional[LLMService]:
@@ -411,11 +775,14 @@ def get_llm_service() -> Optional[LLMService]:
         return None
     
     if _llm_service is None:
-        try:
-            _llm_service = LLMService()
-            logger.info("LLM服务初始化成功")
-        except Exception as e:
-            logger.error(f"LLM服务初始化失败: {e}")
-            return None
+        # 双重检查加锁，保证只创建一个实例（及其HTTP连接池）
+        with _llm_lock:
+            if _llm_service is None:
+                try:
+                    _llm_service = LLMService()
+                    logger.info("LLM服务初始化成功")
+                except Exception as e:
+                    logger.error("LLM服务初始化失败: %s", e)
+                    return None
     
     return _llm_service
@@ -1,41 +1,89 @@
 """
 MinIO OSS上传服务
 """
+import asyncio
 import io
-import uuid
-from typing import List, Union, Literal
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple, Union, Literal
+import numpy as np
+import urllib3
 from PIL import Image
 from minio import Minio
 from minio.error import S3Error
 from app.config import Config
 from app.utils.logger import logger
 
+# 可选依赖pyspng（libspng，PNG编码比Pillow快2-4倍），未安装时使用Pillow编码
+try:
+    import pyspng
+    PYSPNG_AVAILABLE = True
+except ImportError:
+    PYSPNG_AVAILABLE = False
+
+# 可选依赖PyTurboJPEG（libjpeg-turbo，SIMD加速的JPEG编码），未安装或找不到libturbojpeg时使用Pillow编码
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _turbo_jpeg = TurboJPEG()
+    TURBOJPEG_AVAILABLE = True
+except (ImportError, OSError, RuntimeError):
+    TURBOJPEG_AVAILABLE = False
+
+# 输出格式 -> 文件扩展名
+_EXT_MAP = {"png": "png", "jpg": "jpg", "jpeg": "jpg", "webp": "webp"}
+
+# 输出格式 -> 上传时的内容类型
+_CONTENT_TYPE_MAP = {"png": "image/png", "jpg": "image/jpeg", "jpeg": "image/jpeg", "webp": "image/webp"}
+
 
 class OSSService:
     """OSS上传服务类"""
     
     def __init__(self):
         """初始化MinIO客户端"""
+        # 连接池大小与上传线程数一致（minio默认每个host仅10个连接），
+        # 并发上传时每个线程都能复用keep-alive连接，不会出现连接池已满而丢弃连接的情况
+        # 超时（5分钟）与重试策略与minio默认的HTTP客户端保持一致
+        self._http_client = urllib3.PoolManager(
+            timeout=urllib3.Timeout(connect=300, read=300),
+            maxsize=max(10, Config.MINIO_UPLOAD_WORKERS),
+            retries=urllib3.Retry(
+                total=5,
+                backoff_factor=0.2,
+                status_forcelist=[500, 502, 503, 504],
+            ),
+        )
         self.client = Minio(
             Config.MINIO_ENDPOINT,
             access_key=Config.MINIO_ACCESS_KEY,
             secret_key=Config.MINIO_SECRET_KEY,
-            secure=False  # 如果使用HTTPS，设置为True
+            secure=False,  # 如果使用HTTPS，设置为True
+            http_client=self._http_client,
         )
         self.bucket = Config.MINIO_BUCKET
+        # 批量上传复用的线程池（MinIO客户端可在多线程中并发上传）
+        self._upload_pool = ThreadPoolExecutor(
+            max_workers=max(1, Config.MINIO_UPLOAD_WORKERS),
+            thread_name_prefix="oss-upload",
+        )
         self._ensure_bucket_exists()
     
+    def cleanup(self):
+        """关闭上传线程池，并关闭连接池中的连接"""
+        self._upload_pool.shutdown(wait=True)
+        self._http_client.clear()
+    
     def _ensure_bucket_exists(self):
         """确保bucket存在，如果不存在则创建"""
         # 首先尝试直接创建bucket（如果不存在）
         # 这样可以避免 bucket_exists() 的权限检查问题
         try:
             self.client.make_bucket(self.bucket)
-            logger.info(f"创建bucket: {self.bucket}")
+            logger.info("创建bucket: %s", self.bucket)
         except S3Error as e:
             # BucketAlreadyOwnedByYou 或 BucketAlreadyExists 表示bucket已存在，这是正常情况
             if e.code in ("BucketAlreadyOwnedByYou", "BucketAlreadyExists"):
-                logger.info(f"Bucket {self.bucket} 已存在")
+                logger.info("Bucket %s 已存在", self.bucket)
             # AccessDenied 可能表示：
             # 1. bucket已存在但没有检查权限（可以继续使用）
             # 2. 没有创建权限（需要检查用户权限）
@@ -45,10 +93,10 @@ class OSSService:
                     # 尝试列出bucket中的对象（即使为空）来验证bucket是否存在
                     # 如果bucket不存在，会返回NoSuchBucket
                     objects = list(self.client.list_objects(self.bucket, max_keys=1))
-                    logger.info(f"Bucket {self.bucket} 已存在（通过列表对象验证）")
+                    logger.info("Bucket %s 已存在（通过列表对象验证）", self.bucket)
                 except S3Error as list_error:
                     if list_error.code == "NoSuchBucket":
-                        logger.error(f"Bucket {self.bucket} 不存在且无法创建，请检查用户权限")
+                        logger.error("Bucket %s 不存在且无法创建，请检查用户权限", self.bucket)
                         raise
                     elif list_error.code == "AccessDenied":
                         # 既不能创建也不能检查，可能是权限不足
@@ -58,56 +106,70 @@ class OSSService:
                             f"服务将继续运行，但可能在上传时遇到问题"
                         )
                     else:
-                        logger.warning(f"检查bucket时出错: {list_error}，服务将继续运行")
+                        logger.warning("检查bucket时出错: %s，服务将继续运行", list_error)
             else:
                 # 其他错误，记录但不阻止初始化（可能是网络问题等临时性错误）
-                logger.warning(f"创建bucket时出错: {e}。服务将继续运行，但可能在上传时遇到问题")
+                logger.warning("创建bucket时出错: %s。服务将继续运行，但可能在上传时遇到问题", e)
     
-    def _generate_filename(self, output_format: str = "png") -> str:
-        """生成唯一文件名"""
-        file_ext = output_format.lower()
-        if file_ext == "jpeg":
-            file_ext = "jpg"
-        return f"{uuid.uuid4().hex}.{file_ext}"
-    
-    def _image_to_bytes(self, image: Image.Image, output_format: str = "png") -> bytes:
-        """将PIL Image转换为字节流"""
+    def _encode_image(self, image: Image.Image, output_format: str = "png") -> Tuple[io.BytesIO, int]:
+        """将PIL Image编码到内存缓冲区，返回 (已定位到开头的缓冲区, 数据长度)，无需再复制出bytes"""
+        if PYSPNG_AVAILABLE and output_format.lower() == "png" and image.mode in ("RGB", "RGBA"):
+            # PNG格式（无损），使用pyspng编码
+            data = pyspng.encode(np.asarray(image), compress_level=Config.IMAGE_PNG_COMPRESS_LEVEL)
+            return io.BytesIO(data), len(data)
+        
+        if TURBOJPEG_AVAILABLE and output_format.lower() in ("jpg", "jpeg"):
+            # JPEG格式，使用libjpeg-turbo编码（仅在不是RGB模式时转换）
+            rgb = image if image.mode == "RGB" else image.convert("RGB")
+            data = _turbo_jpeg.encode(np.asarray(rgb), quality=Config.IMAGE_JPEG_QUALITY, pixel_format=TJPF_RGB)
+            return io.BytesIO(data), len(data)
+        
         buffer = io.BytesIO()
         
         if output_format.lower() in ["jpg", "jpeg"]:
-            # JPEG格式始终使用100%质量
-            image = image.convert("RGB")  # 确保是RGB模式
-            image.save(buffer, format="JPEG", quality=100)
+            # JPEG格式，质量由配置决定（默认90）；已是RGB模式时不再转换，避免整图复制
+            if image.mode != "RGB":
+                image = image.convert("RGB")
+            image.save(buffer, format="JPEG", quality=Config.IMAGE_JPEG_QUALITY)
+        elif output_format.lower() == "webp":
+            # WebP格式（有损），同等画质下比JPEG更小，减少上传字节数
+            image.save(buffer, format="WEBP", quality=Config.IMAGE_WEBP_QUALITY, method=4)
         else:
-            # PNG格式
-            image.save(buffer, format="PNG")
+            # PNG格式（无损），使用较低的压缩级别以加快编码
+            image.save(buffer, format="PNG", compress_level=Config.IMAGE_PNG_COMPRESS_LEVEL)
         
+        length = buffer.tell()
         buffer.seek(0)
-        return buffer.getvalue()
+        return buffer, length
     
-    def upload_image(self, image: Image.Image, output_format: str = "png") -> str:
+    def upload_image(self, image: Image.Image, output_format: str = "png", file_id: Optional[str] = None) -> str:
         """
         上传单张图片到MinIO，返回服务端代理URL
         
         Args:
             image: PIL Image对象
-            output_format: 输出格式，png/jpg/jpeg
+            output_format: 输出格式，png/jpg/jpeg/webp
+            file_id: 文件名（不含扩展名），为空时随机生成32位十六进制
         
         Returns:
             图片的服务端代理URL
         """
-        filename = self._generate_filename(output_format)
-        image_bytes = self._image_to_bytes(image, output_format)
-        content_type = f"image/{output_format}" if output_format != "jpg" else "image/jpeg"
+        fmt = output_format.lower()
+        # 唯一文件名，扩展名与内容类型均查表得到
+        filename = f"{file_id or secrets.token_hex(16)}.{_EXT_MAP.get(fmt, fmt)}"
+        content_type = _CONTENT_TYPE_MAP.get(fmt, f"image/{fmt}")
+        buffer, length = self._encode_image(image, fmt)
         
         try:
-            self.client.put_object(self.bucket, filename, io.BytesIO(image_bytes), length=len(image_bytes), content_type=content_type)
+            # 上传完成后立即关闭缓冲区，释放编码后的图片数据
+            with buffer:
+                self.client.put_object(self.bucket, filename, buffer, length=length, content_type=content_type)
             # 返回服务端代理URL，而不是MinIO直接URL
             # 这样可以通过服务端代理访问图片，避免直接访问MinIO的权限问题
             url = f"/api/v1/images/{self.bucket}/{filename}"
             return url
         except S3Error as e:
-            logger.error(f"上传图片失败: {e}")
+            logger.error("上传图片失败: %s", e)
             raise
     
     def upload_images(self, images: List[Image.Image], output_format: str = "png") -> List[str]:
@@ -116,16 +178,31 @@ class OSSService:
         
         Args:
             images: PIL Image对象列表
-            output_format: 输出格式，png/jpg/jpeg
+            output_format: 输出格式，png/jpg/jpeg/webp
         
         Returns:
             图片URL列表
         """
-        urls = []
-        logger.info(f"开始批量上传图片: count={len(images)}, format={output_format}")
-        for idx, image in enumerate(images, 1):
-            url = self.upload_image(image, output_format)
-            urls.append(url)
-            logger.debug(f"批量上传进度: {idx}/{len(images)}, url={url}")
-        logger.info(f"批量上传完成: count={len(urls)}, urls={urls}")
+        logger.info("开始批量上传图片: count=%s, format=%s", len(images), output_format)
+        if len(images) <= 1:
+            urls = [self.upload_image(image, output_format) for image in images]
+        else:
+            # 一次性取出所有文件名所需的随机字节，每16字节对应一个文件名
+            raw = secrets.token_bytes(16 * len(images))
+            file_ids = [raw[i:i + 16].hex() for i in range(0, len(raw), 16)]
+            # 在复用的线程池中并发上传（编码与网络往返相互重叠），map保持返回顺序与输入一致
+            urls = list(self._upload_pool.map(
+                lambda image, file_id: self.upload_image(image, output_format, file_id),
+                images,
+                file_ids,
+            ))
+        logger.info("批量上传完成: count=%s, urls=%s", len(urls), urls)
         return urls
+    
+    async def upload_image_async(self, image: Image.Image, output_format: str = "png") -> str:
+        """在线程中上传单张图片，不阻塞事件循环（参数同upload_image）"""
+        return await asyncio.to_thread(self.upload_image, image, output_format)
+    
+    async def upload_images_async(self, images: List[Image.Image], output_format: str = "png") -> List[str]:
+        """在线程中批量上传图片，不阻塞事件循环（参数同upload_images）"""
+        return await asyncio.to_thread(self.upload_images, images, output_format)
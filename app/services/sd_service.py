@@ -2,6 +2,7 @@
 SD模型生成服务（支持LoRA和LoHA）
 """
 import torch
+from io import BytesIO
 from pathlib import Path
 from typing import List, Optional, Dict, Any, Union
 from PIL import Image
@@ -27,6 +28,7 @@ except ImportError:
     COMPEL_AVAILABLE = False
     logger.warning("Compel库未安装，prompt权重语法将无法使用。请运行: pip install compel")
 from app.config import Config
+from app.utils.base64_utils import b64decode_data_uri
 from app.utils.logger import logger
 
 
@@ -507,15 +509,11 @@ class SDService:
             return None
     
     def _decode_base64_image(self, base64_str: str) -> Image.Image:
-        """解码base64图片"""
-        import base64
-        from io import BytesIO
-        
-        # 移除data:image前缀（如果有）
-        if "," in base64_str:
-            base64_str = base64_str.split(",")[1]
-        
-        image_data = base64.b64decode(base64_str)
+        """解码base64图片（支持data:image前缀）"""
+        return self._decode_image_bytes(b64decode_data_uri(base64_str))
+    
+    def _decode_image_bytes(self, image_data: bytes) -> Image.Image:
+        """解码图片二进制数据"""
         image = Image.open(BytesIO(image_data))
         return image.convert("RGB")
     
@@ -618,7 +616,7 @@ class SDService:
     def image_to_image(
         self,
         prompt: str,
-        init_image: Union[str, Image.Image],
+        init_image: Union[str, bytes, Image.Image],
         negative_prompt: Optional[str] = None,
         num_images: int = 1,
         scheduler: Optional[str] = None,
@@ -633,7 +631,7 @@ class SDService:
         
         Args:
             prompt: 提示词
-            init_image: 初始图片（base64字符串或PIL Image）
+            init_image: 初始图片（base64字符串、图片二进制数据或PIL Image）
             negative_prompt: 负面提示词
             num_images: 生成图片张数
             scheduler: 采样方法
@@ -649,6 +647,8 @@ class SDService:
         # 转换初始图片
         if isinstance(init_image, str):
             init_image = self._decode_base64_image(init_image)
+        elif isinstance(init_image, bytes):
+            init_image = self._decode_image_bytes(init_image)
         
         # 确保图片是RGB格式
         if init_image.mode != "RGB":
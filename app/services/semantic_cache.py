@@ -0,0 +1,97 @@
+"""
+语义缓存模块：按文本向量的余弦相似度复用近似请求的提示词转换结果
+"""
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+class SemanticPromptCache:
+    """
+    提示词转换结果的语义缓存
+
+    向量存放在预分配的float32矩阵中（行向量已归一化），查找时一次矩阵乘法得到全部余弦相似度；
+    超出容量时覆盖最久未命中的条目（LRU）
+    """
+
+    def __init__(self, threshold: float = 0.92, max_entries: int = 5000):
+        """
+        Args:
+            threshold: 命中所需的最小余弦相似度
+            max_entries: 最大缓存条目数
+        """
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._embeddings: Optional[np.ndarray] = None  # [max_entries, D]，首次写入时按向量维度分配
+        self._last_used = np.zeros(max_entries, dtype=np.int64)  # 每行最近一次写入/命中的序号
+        self._entries: List[Tuple[str, str]] = []
+        self._tick = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def _normalize(embedding) -> Optional[np.ndarray]:
+        """转换为归一化的float32向量，零向量返回None"""
+        vector = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = float(np.linalg.norm(vector))
+        if norm == 0.0:
+            return None
+        return vector / norm
+
+    def lookup(self, embedding) -> Optional[Tuple[str, str]]:
+        """
+        查找与给定向量最相似的缓存条目
+
+        Args:
+            embedding: 查询文本的向量
+
+        Returns:
+            相似度达到阈值时返回 (prompt, negative_prompt)，否则返回None
+        """
+        size = len(self._entries)
+        if size == 0:
+            return None
+        query = self._normalize(embedding)
+        if query is None or query.shape[0] != self._embeddings.shape[1]:
+            return None
+
+        scores = self._embeddings[:size] @ query
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+
+        self._tick += 1
+        self._last_used[best] = self._tick
+        return self._entries[best]
+
+    def add(self, embedding, entry: Tuple[str, str]):
+        """
+        写入一条缓存
+
+        Args:
+            embedding: 文本向量
+            entry: (prompt, negative_prompt) 元组
+        """
+        if self.max_entries <= 0:
+            return
+        vector = self._normalize(embedding)
+        if vector is None:
+            return
+        if self._embeddings is None:
+            self._embeddings = np.empty((self.max_entries, vector.shape[0]), dtype=np.float32)
+        elif vector.shape[0] != self._embeddings.shape[1]:
+            return
+
+        size = len(self._entries)
+        if size < self.max_entries:
+            row = size
+            self._entries.append(entry)
+        else:
+            # 覆盖最久未使用的条目
+            row = int(np.argmin(self._last_used))
+            self._entries[row] = entry
+
+        self._embeddings[row] = vector
+        self._tick += 1
+        self._last_used[row] = self._tick
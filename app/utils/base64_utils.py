@@ -0,0 +1,26 @@
+"""
+base64编解码工具：优先使用pybase64，并提供data URI前缀处理
+"""
+# 可选依赖pybase64（SIMD加速，接口与标准库base64兼容），未安装时使用标准库
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+# data URI前缀（如 data:image/png;base64,）的最大查找长度
+_DATA_URI_PREFIX_MAX_LEN = 64
+
+
+def strip_data_uri(data: str) -> str:
+    """
+    移除base64字符串的data URI前缀（data:image/...;base64,），没有前缀时原样返回
+
+    前缀很短，只在开头查找分隔符，避免扫描整个base64字符串
+    """
+    idx = data.find(",", 0, _DATA_URI_PREFIX_MAX_LEN)
+    return data[idx + 1:] if idx >= 0 else data
+
+
+def b64decode_data_uri(data: str) -> bytes:
+    """解码base64字符串（支持data URI前缀）"""
+    return base64.b64decode(strip_data_uri(data))
@@ -0,0 +1,9 @@
+"""
+HTTP客户端相关工具
+"""
+# HTTP/2需要可选依赖h2（pip install httpx[http2]），未安装时使用HTTP/1.1
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
@@ -2,7 +2,10 @@
 日志配置模块
 统一管理应用的日志输出，抑制第三方库的详细日志
 """
+import atexit
 import logging
+import logging.handlers
+import queue
 import sys
 from pathlib import Path
 
@@ -41,13 +44,14 @@ def setup_logger(
         return logger
     
     formatter = logging.Formatter(LOG_FORMAT, DATE_FORMAT)
+    handlers = []
     
     # 控制台输出
     if console:
         console_handler = logging.StreamHandler(sys.stdout)
         console_handler.setLevel(level)
         console_handler.setFormatter(formatter)
-        logger.addHandler(console_handler)
+        handlers.append(console_handler)
     
     # 文件输出
     if log_file:
@@ -57,7 +61,15 @@ def setup_logger(
         )
         file_handler.setLevel(level)
         file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
+        handlers.append(file_handler)
+    
+    if handlers:
+        # 日志记录只写入内存队列，由后台线程统一写控制台和文件，避免在事件循环中执行阻塞I/O
+        log_queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
     
     return logger
 
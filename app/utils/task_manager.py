@@ -6,7 +6,7 @@ import json
 from typing import Dict, Optional, Union, List
 from datetime import datetime
 from pathlib import Path
-from app.models.task import Task, TaskStatus
+from app.models.task import Task, TaskStatus, TaskStatusValue
 from app.config import Config
 
 
@@ -86,7 +86,7 @@ class TaskManager:
         
         task = Task(
             task_id=row['task_id'],
-            status=TaskStatus(row['status']),
+            status=row['status'],
             created_at=datetime.fromisoformat(row['created_at']),
             updated_at=datetime.fromisoformat(row['updated_at']),
             result_url=row['result_url'] if 'result_url' in row.keys() else None,
@@ -120,7 +120,7 @@ class TaskManager:
         cursor.execute("""
             INSERT INTO tasks (task_id, status, created_at, updated_at, callback_url, prompt, negative_prompt)
             VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (task_id, TaskStatus.PENDING.value, now, now, callback_url, prompt, negative_prompt))
+        """, (task_id, TaskStatus.PENDING, now, now, callback_url, prompt, negative_prompt))
         
         conn.commit()
         conn.close()
@@ -161,7 +161,7 @@ class TaskManager:
             return self._row_to_task(row)
         return None
     
-    def update_status(self, task_id: str, status: TaskStatus):
+    def update_status(self, task_id: str, status: TaskStatusValue):
         """
         更新任务状态
         
@@ -178,7 +178,7 @@ class TaskManager:
             UPDATE tasks 
             SET status = ?, updated_at = ?
             WHERE task_id = ?
-        """, (status.value, updated_at, task_id))
+        """, (status, updated_at, task_id))
         
         conn.commit()
         conn.close()
@@ -203,14 +203,14 @@ class TaskManager:
                 UPDATE tasks 
                 SET status = ?, result_urls = ?, updated_at = ?
                 WHERE task_id = ?
-            """, (TaskStatus.COMPLETED.value, result_urls_json, updated_at, task_id))
+            """, (TaskStatus.COMPLETED, result_urls_json, updated_at, task_id))
         else:
             # 单张图片：存储到result_url
             cursor.execute("""
                 UPDATE tasks 
                 SET status = ?, result_url = ?, updated_at = ?
                 WHERE task_id = ?
-            """, (TaskStatus.COMPLETED.value, url, updated_at, task_id))
+            """, (TaskStatus.COMPLETED, url, updated_at, task_id))
         
         conn.commit()
         conn.close()
@@ -232,12 +232,12 @@ class TaskManager:
             UPDATE tasks 
             SET status = ?, error_message = ?, updated_at = ?
             WHERE task_id = ?
-        """, (TaskStatus.FAILED.value, error_message, updated_at, task_id))
+        """, (TaskStatus.FAILED, error_message, updated_at, task_id))
         
         conn.commit()
         conn.close()
     
-    def get_all_tasks(self, status: Optional[TaskStatus] = None) -> Dict[str, Task]:
+    def get_all_tasks(self, status: Optional[TaskStatusValue] = None) -> Dict[str, Task]:
         """
         获取所有任务（可选按状态筛选）
         
@@ -253,7 +253,7 @@ class TaskManager:
         if status:
             cursor.execute("""
                 SELECT * FROM tasks WHERE status = ? ORDER BY created_at DESC
-            """, (status.value,))
+            """, (status,))
         else:
             cursor.execute("""
                 SELECT * FROM tasks ORDER BY created_at DESC